@@ -17,13 +17,28 @@ Repository Management
 """
 
 import atexit
+import binascii
+import contextlib
+import ctypes
+import errno
+import fcntl
 import fnmatch
 import hashlib
+import json
 import os
 import os.path
 import re
+import shutil
 import signal
-from subprocess import Popen, PIPE
+import tempfile
+import threading
+from multiprocessing.dummy import Pool as ThreadPool
+from subprocess import Popen, PIPE, call
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 default_root = "/mcs/globus.org/ftppub/gt6"
 default_api_root = "/mcs/globus.org/api"
@@ -64,35 +79,722 @@ EESufsL68kNlBuAAnRRI5jFAvyjtQaoQpVqSL4/O45D7AJ9WrW/vxTzN0OyZyUU6
 uid = os.getuid()
 gid = None
 
+"""
+Directory holding local state kept between runs, such as parsed repository
+metadata. Set to None to disable caching. Defaults to the value of the
+GLOBUS_RELEASE_TOOLS_CACHE environment variable or
+~/.cache/globus-release-tools
+"""
+cache_dir = os.getenv(
+    "GLOBUS_RELEASE_TOOLS_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "globus-release-tools"))
+
+"""
+If True, repository metadata is generated in a staging directory and renamed
+into place, so readers of the repository never see partially written
+metadata
+"""
+stage_metadata = True
+
+"""
+Default number of repositories whose metadata is updated at the same time
+by Release.update_metadata
+"""
+metadata_workers = 4
+
+"""
+Format version of the parsed package cache. Cache entries written with a
+different version are ignored.
+"""
+package_cache_version = 2
+
+
+def _cache_path(*parts):
+    """
+    Return the path to *parts* within the cache_dir, creating its parent
+    directory if needed. Returns None if caching is disabled or the
+    directory can't be created.
+    """
+    if cache_dir is None:
+        return None
+    path = os.path.join(cache_dir, *parts)
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname, 0o700)
+        except OSError:
+            if not os.path.isdir(dirname):
+                return None
+    return path
+
+
+@contextlib.contextmanager
+def _locked(path):
+    """
+    Hold an exclusive lock on the file at *path*, which is created if it
+    does not exist, for the duration of a with statement. Other processes
+    and threads locking the same file wait until it is released.
+    """
+    lock_file = open(path, "a")
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        yield
+    finally:
+        lock_file.close()
+
+
+_scratch_dir = None
+_scratch_dir_lock = threading.Lock()
+
+
+def _scratch_path(*parts):
+    """
+    Return the path to *parts* within the cache_dir, or within a private
+    temporary directory that is removed when the process exits if caching is
+    disabled. Used for derived files, such as decompressed metadata, which
+    must not be written into the published repositories.
+    """
+    global _scratch_dir
+
+    path = _cache_path(*parts)
+    if path is not None:
+        return path
+    with _scratch_dir_lock:
+        if _scratch_dir is None:
+            _scratch_dir = tempfile.mkdtemp(prefix="globus-release-tools.")
+            atexit.register(shutil.rmtree, _scratch_dir, True)
+    path = os.path.join(_scratch_dir, *parts)
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path), 0o700)
+        except OSError as e:
+            # Another thread may have created it
+            if e.errno != errno.EEXIST:
+                raise
+    return path
+
+
+def _write_atomic(path, data, mode=None):
+    """
+    Write *data* to a temporary file in the same directory as *path* and
+    rename it into place, so that readers see either the old or the new
+    contents of *path*. The file is private to the user unless a permission
+    *mode* is passed.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix="." + os.path.basename(path) + ".")
+    try:
+        if mode is not None:
+            os.fchmod(fd, mode)
+        f = os.fdopen(fd, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+"""
+Methods tried in order by _copy_file to copy a package into a repository:
+'link' (hard link), 'reflink' (copy-on-write clone, or an in-kernel copy
+with copy_file_range), and 'copy'. Defaults to the comma-separated
+list in the GLOBUS_RELEASE_TOOLS_COPY_STRATEGIES environment variable, or all
+three.
+"""
+copy_strategies = os.getenv(
+    "GLOBUS_RELEASE_TOOLS_COPY_STRATEGIES", "link,reflink,copy").split(",")
+
+# ioctl request to clone a file's extents (FICLONE from linux/fs.h)
+_FICLONE = 0x40049409
+
+try:
+    _copy_file_range = ctypes.CDLL(None, use_errno=True).copy_file_range
+    _copy_file_range.restype = ctypes.c_ssize_t
+    _copy_file_range.argtypes = [
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_size_t, ctypes.c_uint]
+except (OSError, AttributeError):
+    _copy_file_range = None
+
+
+def _reflink(src_fd, dst_fd, size):
+    """
+    Copy the contents of *src_fd* to *dst_fd* without passing the data
+    through this process, by cloning the file's extents or with
+    copy_file_range. Raises IOError or OSError if neither is supported.
+    """
+    try:
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+        return
+    except IOError:
+        if _copy_file_range is None:
+            raise
+    copied = 0
+    while copied < size:
+        count = _copy_file_range(src_fd, None, dst_fd, None, size - copied, 0)
+        if count < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        if count == 0:
+            break
+        copied += count
+
+
+"""
+Errors from os.link which mean that a hard link cannot be made, so that
+_copy_file tries its next copy strategy
+"""
+_link_unsupported_errors = frozenset([
+    errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK])
+
+
+def _link_temporary(src, dirname, prefix, link=os.link):
+    """
+    Create a hard link to *src* in *dirname* with a random name starting
+    with *prefix* and return its path. If a file with the name already
+    exists, the link is tried again with a new name. Pass os.symlink as
+    *link* to create a symbolic link instead.
+    """
+    for i in range(tempfile.TMP_MAX):
+        tmp_path = os.path.join(
+            dirname, prefix + binascii.hexlify(os.urandom(6)))
+        try:
+            link(src, tmp_path)
+            return tmp_path
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    raise OSError(errno.EEXIST, "No usable temporary file name", dirname)
+
+
+def _copy_file(src, dst):
+    """
+    Copy the file *src* to *dst*, using the first of the copy_strategies
+    that works. The copy is made with a temporary name in the directory of
+    *dst* and renamed over it, so an existing *dst*, which may be a hard link
+    to files in other repositories, is replaced and never written to. The
+    'link' strategy is skipped when the file system cannot link *src* to
+    *dst*, but other errors are raised. Returns the name of the strategy
+    used.
+    """
+    dirname, basename = os.path.split(dst)
+    prefix = "." + basename + "."
+    failures = []
+    for strategy in copy_strategies:
+        if strategy == 'link':
+            try:
+                tmp_path = _link_temporary(src, dirname, prefix)
+            except OSError as e:
+                if e.errno not in _link_unsupported_errors:
+                    raise
+                failures.append(e)
+                continue
+        elif strategy in ('reflink', 'copy'):
+            fd, tmp_path = tempfile.mkstemp(prefix=prefix, dir=dirname)
+            try:
+                src_file = open(src, "rb")
+                try:
+                    if strategy == 'reflink':
+                        _reflink(
+                            src_file.fileno(), fd,
+                            os.fstat(src_file.fileno()).st_size)
+                    else:
+                        dst_file = os.fdopen(fd, "wb")
+                        fd = None
+                        try:
+                            shutil.copyfileobj(src_file, dst_file, 1 << 20)
+                        finally:
+                            dst_file.close()
+                finally:
+                    src_file.close()
+                shutil.copymode(src, tmp_path)
+            except (IOError, OSError) as e:
+                os.remove(tmp_path)
+                failures.append(e)
+                continue
+            finally:
+                if fd is not None:
+                    os.close(fd)
+        else:
+            raise ValueError("Unknown copy strategy", strategy)
+        try:
+            os.rename(tmp_path, dst)
+        except:
+            os.remove(tmp_path)
+            raise
+        return strategy
+    if failures:
+        raise failures[-1]
+    raise ValueError("No copy strategies")
+
+
+def _metadata_signature(path):
+    """
+    Return the stat information used to detect changes to a repository
+    metadata file or directory
+    """
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+def _metadata_digest(path):
+    """
+    Return the SHA1 hash of a repository metadata file, or of the sorted
+    list of entries of a directory
+    """
+    digester = hashlib.sha1()
+    if os.path.isdir(path):
+        for entry in sorted(os.listdir(path)):
+            digester.update(entry + "\n")
+    else:
+        f = open(path, "rb")
+        try:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digester.update(chunk)
+        finally:
+            f.close()
+    return digester.hexdigest()
+
+
+"""
+Hash algorithms of the checksum files written next to each package
+"""
+digest_algorithms = ['md5', 'sha1', 'sha512']
+
+"""
+Size of the blocks read from a file while computing its hashes
+"""
+digest_block_size = 1 << 20
+
+"""
+Default number of threads used by _digest_files. The hash functions release
+the interpreter lock while hashing each block, so files are hashed in
+parallel.
+"""
+digest_workers = 4
+
+
+def _multipart_key(part_size):
+    return "multipart-md5-%d" % part_size
+
+
+def _file_digests(filename, part_size=None):
+    """
+    Compute the hashes named in digest_algorithms of a file, reading it once
+    in blocks of digest_block_size bytes. Returns a dict mapping each
+    algorithm name to the hex digest. If *part_size* is not None, the dict
+    also contains the multipart MD5 of the file split into parts of
+    *part_size* bytes, in the form used for the ETags of objects uploaded
+    in parts to S3: the MD5 of the concatenated MD5s of the parts, followed
+    by a '-' and the number of parts.
+    """
+    digesters = [hashlib.new(h) for h in digest_algorithms]
+    part_digests = []
+    part_digester = hashlib.md5()
+    part_remaining = part_size
+    f = open(filename, "rb")
+    try:
+        for block in iter(lambda: f.read(digest_block_size), b""):
+            for digester in digesters:
+                digester.update(block)
+            while part_size is not None and block:
+                part_digester.update(block[:part_remaining])
+                if len(block) < part_remaining:
+                    part_remaining -= len(block)
+                    break
+                block = block[part_remaining:]
+                part_digests.append(part_digester.digest())
+                part_digester = hashlib.md5()
+                part_remaining = part_size
+    finally:
+        f.close()
+    digests = dict(
+        (h, digester.hexdigest())
+        for (h, digester) in zip(digest_algorithms, digesters))
+    if part_size is not None:
+        if part_remaining != part_size or not part_digests:
+            part_digests.append(part_digester.digest())
+        digests[_multipart_key(part_size)] = "%s-%d" % (
+            hashlib.md5(b"".join(part_digests)).hexdigest(),
+            len(part_digests))
+    return digests
+
+
+"""
+Format version of the digest manifests. Manifests written with a different
+version are ignored.
+"""
+digest_manifest_version = 3
+
+
+def _stat_key(st):
+    """
+    Return the (inode, size, mtime in nanoseconds) tuple used to detect
+    changes to a file from its stat result *st*
+    """
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(st.st_mtime * 1000000000))
+    return (st.st_ino, st.st_size, mtime_ns)
+
+
+class DigestManifest(object):
+    """
+    DigestManifest class
+    ====================
+    Records the hashes of the files in a directory, keyed by each file's
+    inode, size, and modification time, so that a file's hashes are only
+    computed again after it changes. The manifest is kept in the cache_dir
+    between runs, or only in memory if caching is disabled. It is stored as
+    JSON, so reading it never runs code from the file.
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.path = _cache_path("digests", hashlib.sha1(
+            self.directory).hexdigest() + ".json")
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if self.path is not None and os.path.exists(self.path):
+            try:
+                f = open(self.path, "rb")
+                try:
+                    entry = json.load(f)
+                finally:
+                    f.close()
+                if entry['version'] == digest_manifest_version and \
+                        entry['directory'] == self.directory:
+                    for name, (key, digests) in entry['entries'].items():
+                        self.entries[name.encode("utf-8")] = (
+                            tuple(key),
+                            dict((str(h), str(d))
+                                 for (h, d) in digests.items()))
+            except Exception:
+                self.entries = {}
+
+    def known(self, filename):
+        """
+        Return True if the manifest has hashes for some version of the file
+        named *filename* in its directory
+        """
+        with self.lock:
+            return os.path.basename(filename) in self.entries
+
+    def lookup(self, filename):
+        """
+        Return the dict of hashes recorded for *filename*, or None if there
+        are none or the file has changed since they were recorded
+        """
+        key = _stat_key(os.stat(filename))
+        with self.lock:
+            entry = self.entries.get(os.path.basename(filename))
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        return None
+
+    def update(self, filename, digests, st=None):
+        """
+        Record the dict of *digests* of *filename*, with the stat
+        result *st* of the file when they were computed (the current one
+        if None)
+        """
+        if st is None:
+            st = os.stat(filename)
+        with self.lock:
+            self.entries[os.path.basename(filename)] = (
+                _stat_key(st), digests)
+            self.dirty = True
+
+    def file_digests(self, filename, part_size=None):
+        """
+        Return a dict mapping each of digest_algorithms to the hex digest of
+        *filename*, computing and recording the hashes if they are not in
+        the manifest. If *part_size* is not None, the dict also contains
+        the multipart MD5 computed by _file_digests for that part size.
+        """
+        recorded = self.lookup(filename)
+        digests = recorded
+        if digests is None or (
+                part_size is not None and
+                _multipart_key(part_size) not in digests):
+            st = os.stat(filename)
+            digests = _file_digests(filename, part_size)
+            if recorded is not None:
+                # Keep the multipart MD5s for other part sizes
+                digests = dict(recorded, **digests)
+            # Don't record hashes of a file modified while it was read
+            if _stat_key(os.stat(filename)) == _stat_key(st):
+                self.update(filename, digests, st)
+        return digests
+
+    def save(self):
+        """
+        Write the manifest to the cache_dir if it has changed, dropping
+        entries for files which no longer exist
+        """
+        with self.lock:
+            if not self.dirty or self.path is None:
+                return
+            for name in self.entries.keys():
+                if not os.path.exists(os.path.join(self.directory, name)):
+                    del self.entries[name]
+            try:
+                data = json.dumps({
+                    'version': digest_manifest_version,
+                    'directory': self.directory,
+                    'entries': self.entries,
+                })
+            except ValueError:
+                # File names which are not valid UTF-8
+                return
+            self.dirty = False
+        try:
+            _write_atomic(self.path, data)
+        except (IOError, OSError):
+            pass
+
+
+_digest_manifests = {}
+_digest_manifests_lock = threading.Lock()
+
+
+def digest_manifest(directory):
+    """
+    Return the DigestManifest for *directory*, shared by all callers in this
+    process. Manifests are saved when save_digest_manifests is called and
+    when the process exits.
+    """
+    directory = os.path.abspath(directory)
+    with _digest_manifests_lock:
+        if not _digest_manifests:
+            atexit.register(save_digest_manifests)
+        manifest = _digest_manifests.get(directory)
+        if manifest is None:
+            manifest = DigestManifest(directory)
+            _digest_manifests[directory] = manifest
+    return manifest
+
+
+def file_digests(path, part_size=None):
+    """
+    Return a dict mapping each of digest_algorithms to the hex digest of the
+    file at *path*, using the digest manifest of its directory. If
+    *part_size* is not None, the dict also contains the file's multipart
+    MD5 for that part size.
+    """
+    return digest_manifest(os.path.dirname(path)).file_digests(
+        path, part_size)
+
+
+def multipart_md5(path, part_size):
+    """
+    Return the multipart MD5 of the file at *path* split into parts of
+    *part_size* bytes, as used for the ETag of an S3 object uploaded in
+    parts, using the digest manifest of its directory
+    """
+    return file_digests(path, part_size)[_multipart_key(part_size)]
+
+
+def save_digest_manifests():
+    """
+    Write all changed digest manifests to their directories
+    """
+    with _digest_manifests_lock:
+        manifests = _digest_manifests.values()
+    for manifest in manifests:
+        manifest.save()
+
 
 def _digest_file(filename, force=False):
     """
     Compute the md5, sha1, sha512 hashes of a file and write them to disk.
+    The hashes are taken from the digest manifest of the file's directory
+    when the file has not changed since they were recorded. Existing hash
+    files are rewritten if the manifest shows that the file has changed
+    since it was last hashed and their contents differ.
 
     Parameters
     ----------
     *filename*::
         Name of the file to compute the hash of (str)
     *force*::
-        Overwrite existing hash file (bool [False])
+        Overwrite existing hash files of files which have changed or are
+        not in the digest manifest (bool [False])
     """
-    if fnmatch.fnmatch(filename, "*.md5") or \
-            fnmatch.fnmatch(filename, "*.sha1") or \
-            fnmatch.fnmatch(filename, "*.sha512"):
+    for h in digest_algorithms:
+        if fnmatch.fnmatch(filename, "*." + h):
+            return
+
+    manifest = digest_manifest(os.path.dirname(filename))
+    digests = manifest.lookup(filename)
+    rewrite = digests is None and (force or manifest.known(filename))
+    hashnames = [
+        (h, filename + "." + h) for h in digest_algorithms
+        if rewrite or not os.path.exists(filename + "." + h)]
+    if len(hashnames) == 0:
         return
 
-    for h in ['md5', 'sha1', 'sha512']:
-        hashname = filename + "." + h
-        if force or not os.path.exists(hashname):
-            digester = hashlib.new(h)
-            f = file(filename, "r")
-            digester.update(f.read())
-            f.close()
-            f = file(hashname, "w")
-            f.write(
-                "%s  %s\n" %
-                (digester.hexdigest(), filename.split(os.sep)[-1]))
-            f.close()
+    if digests is None:
+        digests = manifest.file_digests(filename)
+    for h, hashname in hashnames:
+        data = "%s  %s\n" % (digests[h], filename.split(os.sep)[-1])
+        if os.path.exists(hashname):
+            f = file(hashname, "r")
+            try:
+                if f.read() == data:
+                    continue
+            finally:
+                f.close()
+        f = file(hashname, "w")
+        f.write(data)
+        f.close()
+
+
+def _digest_files(filenames, force=False, workers=None):
+    """
+    Compute and write the hashes of each of *filenames*, as _digest_file
+    does, using a pool of *workers* threads (digest_workers if None).
+    """
+    if workers is None:
+        workers = digest_workers
+    if workers <= 1 or len(filenames) <= 1:
+        for filename in filenames:
+            _digest_file(filename, force)
+        return
+    pool = ThreadPool(min(workers, len(filenames)))
+    try:
+        pool.map(lambda filename: _digest_file(filename, force), filenames, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _version_key(package):
+    return package.version._key
+
+
+def _insort_package(packages, package):
+    """
+    Insert *package* into the version-ordered list *packages*, after any
+    packages with an equal version. The position is found with a binary
+    search on the packages' precomputed version keys.
+    """
+    key = _version_key(package)
+    lo = 0
+    hi = len(packages)
+    if hi > 0 and key >= _version_key(packages[-1]):
+        lo = hi
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key < _version_key(packages[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+    packages.insert(lo, package)
+
+
+def _merge_packages(packages, new_packages):
+    """
+    Insert all of the metadata in the *new_packages* list into the
+    version-ordered list *packages*
+    """
+    if len(new_packages) == 1:
+        _insort_package(packages, new_packages[0])
+        return
+    # Sort the batch on its own first, so the list sort sees two sorted
+    # runs and merges them in linear time. The sort is stable, so new
+    # packages go after existing ones with an equal version.
+    packages.extend(sorted(new_packages, key=_version_key))
+    packages.sort(key=_version_key)
+
+
+def _parallel_map(func, items, pool=None):
+    """
+    Return the list of func(item) for each of *items*, in order. If *pool*
+    is not None, the calls are run concurrently by the pool's workers.
+    """
+    if pool is None:
+        return [func(item) for item in items]
+    return pool.map(func, items, 1)
+
+
+def _run_command(args, failures):
+    """
+    Run the command *args* and append a message to the list *failures* if
+    it does not exit successfully. Returns True if the command succeeded.
+    """
+    status = call(args)
+    if status != 0:
+        failures.append("%s exited with status %d" % (" ".join(args), status))
+    return status == 0
+
+
+def _update_metadata(repositories, force=False, workers=None):
+    """
+    Call update_metadata(force) for each of *repositories*, updating up to
+    *workers* (metadata_workers if None) of them at the same time.
+    Repositories with the same repo_path, such as the deb repositories which
+    share a reprepro base directory, are updated one after another by the
+    same thread. Returns the combined list of failures from all of the
+    repositories.
+    """
+    if workers is None:
+        workers = metadata_workers
+    groups = []
+    by_path = dict()
+    for repository in repositories:
+        path = os.path.abspath(repository.repo_path)
+        if path not in by_path:
+            by_path[path] = []
+            groups.append(by_path[path])
+        by_path[path].append(repository)
+
+    def update_group(group):
+        failures = []
+        for repository in group:
+            failures.extend(repository.update_metadata(force))
+        return failures
+
+    if workers <= 1 or len(groups) <= 1:
+        results = [update_group(group) for group in groups]
+    else:
+        pool = ThreadPool(min(workers, len(groups)))
+        try:
+            results = pool.map(update_group, groups, 1)
+        finally:
+            pool.close()
+            pool.join()
+    return [failure for failures in results for failure in failures]
+
+
+def _load_releases(release_names, load_release, workers=None):
+    """
+    Return a dict mapping each of the *release_names* to the result of
+    calling load_release(name, pool). If *workers* is greater than 1, the
+    releases are loaded at the same time and *pool* is a thread pool of that
+    many workers, shared by all of the releases, for loading their
+    repositories. Otherwise, *pool* is None and everything is loaded
+    serially.
+    """
+    if not release_names:
+        return {}
+    if workers is None or workers <= 1:
+        return dict(
+            (name, load_release(name, None)) for name in release_names)
+    pool = ThreadPool(workers)
+    release_pool = ThreadPool(len(release_names))
+    try:
+        loaded = release_pool.map(
+            lambda name: load_release(name, pool), release_names, 1)
+    finally:
+        release_pool.close()
+        pool.close()
+        release_pool.join()
+        pool.join()
+    return dict(zip(release_names, loaded))
 
 
 class Repository(object):
@@ -107,6 +809,131 @@ class Repository(object):
     """
     def __init__(self):
         self.packages = {}
+        self._source_index = None
+
+    def _cached_packages(
+            self, metadata_path, parse, variant="", dependencies=None):
+        """
+        Return the list of package metadata parsed from *metadata_path* by
+        calling *parse*(*metadata_path*). If the cache_dir holds the result
+        of parsing the same file, with the same *variant* string, in an
+        earlier run and the file's stat information or hash still
+        matches, the cached result is returned instead. If the parser also
+        depends on other files, *dependencies* is a value describing their
+        state, and the cached result is only used if it is unchanged.
+        """
+        cache_path = _cache_path("packages", hashlib.sha1(
+            "\0".join([
+                self.__class__.__module__, variant,
+                os.path.abspath(metadata_path)])).hexdigest() + ".pickle")
+        try:
+            signature = _metadata_signature(metadata_path)
+        except OSError:
+            # Let the parser report the missing metadata
+            return parse(metadata_path)
+        if cache_path is not None and os.path.exists(cache_path):
+            entry = None
+            try:
+                f = open(cache_path, "rb")
+                try:
+                    entry = pickle.load(f)
+                finally:
+                    f.close()
+                if entry['version'] != package_cache_version or \
+                        entry['path'] != metadata_path or \
+                        entry['dependencies'] != dependencies:
+                    entry = None
+                elif entry['signature'] != signature:
+                    if entry['digest'] == _metadata_digest(metadata_path):
+                        entry['signature'] = signature
+                        _write_atomic(cache_path, pickle.dumps(entry, 2))
+                    else:
+                        entry = None
+            except Exception:
+                entry = None
+            if entry is not None:
+                import repo.package
+                return [
+                    repo.package.Metadata(*p) for p in entry['packages']]
+
+        packages = parse(metadata_path)
+
+        if cache_path is not None:
+            try:
+                digest = _metadata_digest(metadata_path)
+                if _metadata_signature(metadata_path) == signature:
+                    _write_atomic(cache_path, pickle.dumps({
+                        'version': package_cache_version,
+                        'path': metadata_path,
+                        'signature': signature,
+                        'digest': digest,
+                        'dependencies': dependencies,
+                        'packages': [
+                            (p.name, p.version.strversion, p.version.release,
+                                p.path, p.arch, p.source_name, p.os)
+                            for p in packages],
+                    }, 2))
+            except (IOError, OSError):
+                pass
+        return packages
+
+    def _source_packages(self):
+        """
+        Return the index of this repository's packages keyed by source
+        package name, building it from self.packages the first time it is
+        needed. Repositories that are never searched by source do not pay
+        for the index
+        """
+        if self._source_index is None:
+            index = {}
+            for name in self.packages:
+                for package in self.packages[name]:
+                    if package.source_name not in index:
+                        index[package.source_name] = []
+                    index[package.source_name].append(package)
+            for packages in index.values():
+                packages.sort(key=_version_key)
+            self._source_index = index
+        return self._source_index
+
+    def _indexes(self):
+        """
+        Return a list of (index, key function) pairs for the package lists
+        kept by this repository: self.packages, keyed by name, and the
+        index keyed by source name if it has been built
+        """
+        indexes = [(self.packages, lambda p: p.name)]
+        if self._source_index is not None:
+            indexes.append((self._source_index, lambda p: p.source_name))
+        return indexes
+
+    def _insert_package(self, package):
+        """
+        Add the metadata for *package* to this repository's package lists
+        and indexes, keeping them in version order
+        """
+        for index, keyfunc in self._indexes():
+            key = keyfunc(package)
+            if key not in index:
+                index[key] = []
+            _insort_package(index[key], package)
+
+    def _insert_packages(self, packages):
+        """
+        Add the metadata for all of the *packages* to this repository's
+        package lists and indexes, merging each affected list once
+        """
+        for index, keyfunc in self._indexes():
+            batches = {}
+            for package in packages:
+                key = keyfunc(package)
+                if key not in batches:
+                    batches[key] = []
+                batches[key].append(package)
+            for key in batches:
+                if key not in index:
+                    index[key] = []
+                _merge_packages(index[key], batches[key])
 
     def get_packages(
             self, name=None, arch=None, version=None, source=None,
@@ -123,25 +950,29 @@ class Repository(object):
         if source is not None:
             return [
                 (package)
-                for package_list in self.packages
-                for package in self.packages[package_list]
-                if package.source_name == source.source_name
-                and package.version == source.version
+                for package in self._source_packages().get(
+                    source.source_name, [])
+                if package.version == source.version
             ]
         elif name is not None:
-            if name in self.packages:
-                if version is not None:
+            if version is not None:
+                package_candidates = [
+                    (pkg)
+                    for pkg in self.packages.get(name, [])
+                    if pkg.version == version
+                ]
+                if arch is not None:
                     package_candidates = [
-                        (pkg) for pkg in self.packages[name]
-                        if pkg.version == version
+                        (p)
+                        for p in package_candidates if p.arch == arch
                     ]
-                else:
-                    package_candidates = self.packages[name]
-            if arch is not None:
+            elif arch is not None:
                 package_candidates = [
                     (p)
-                    for p in package_candidates if p.arch == arch
+                    for p in self.packages.get(name, []) if p.arch == arch
                 ]
+            else:
+                package_candidates = self.packages.get(name, [])
             if newest_only and len(package_candidates) > 0:
                 newv = package_candidates[-1].version
                 return [p for p in package_candidates if p.version == newv]
@@ -174,17 +1005,19 @@ class Repository(object):
         -------
         Boolean
         """
-        matches = self.get_packages(pkg.name, arch=pkg.arch, newest_only=True)
-
-        return matches == [] or pkg > matches[-1]
+        for p in reversed(self.packages.get(pkg.name, [])):
+            if p.arch == pkg.arch:
+                return pkg > p
+        return True
 
     def __contains__(self, pkg):
         """
         Check to see if pkg is included in this Repository
         """
-        return len(self.get_packages(
-            name=pkg.name, arch=pkg.arch,
-            version=pkg.version, newest_only=True)) > 0
+        for p in self.packages.get(pkg.name, []):
+            if p.arch == pkg.arch and p.version == pkg.version:
+                return True
+        return False
 
     def __iter__(self):
         """
@@ -223,9 +1056,16 @@ class Release(object):
             repository.add_package(package, update_metadata)
             for repository in self.repositories_for_package(package)]
 
-    def update_metadata(self, osname=None, arch=None, force=False):
-        for repository in self.repositories_for_os_arch(osname, arch):
-            repository.update_metadata(force)
+    def update_metadata(
+            self, osname=None, arch=None, force=False, workers=None):
+        """
+        Update the metadata of this release's repositories for *osname* and
+        *arch* (all of them if None), using up to *workers* threads
+        (metadata_workers if None). Returns a list of messages describing
+        the failed updates, which is empty if all of them succeeded.
+        """
+        return _update_metadata(
+            self.repositories_for_os_arch(osname, arch), force, workers)
 
     def repositories_for_os_arch(self, osname, arch):
         if osname is not None:
@@ -269,6 +1109,8 @@ class Release(object):
 class Manager(object):
     def __init__(self, releases):
         self.releases = releases
+        # Messages describing the metadata updates which failed
+        self.failures = []
 
     def get_release(self, releasename):
         return self.releases[releasename]
@@ -314,7 +1156,8 @@ class Manager(object):
         Returns
         -------
             This function returns a list of packages that were promoted
-            (or would have been if dryrun=False)
+            (or would have been if dryrun=False). Failed metadata updates
+            are added to the Manager's failures list.
         """
         from_release = self.get_release(from_release)
 
@@ -347,7 +1190,7 @@ class Manager(object):
                         result.append(package)
 
         if not dryrun:
-            to_release_object.update_metadata()
+            self.failures.extend(to_release_object.update_metadata())
         return result
 
 
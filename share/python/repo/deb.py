@@ -17,16 +17,157 @@ Package to manage the Globus Toolkit Debian repositories
 """
 
 import gzip
+import hashlib
 import os
 import os.path
 import re
 import repo
 import repo.package
+import shutil
+import tempfile
+import threading
 
 default_codenames = ['squeeze', 'wheezy', 'lucid', 'precise', 'trusty']
 default_arches = ['i386', 'amd64', 'source']
 codename_re = re.compile(r"Codename:\s*(\S+)")
 distro_re = re.compile(r"Distribution:\s*(\S+)")
+stanza_field_re = re.compile(
+    r"^(Package|Source|Version|Filename|Architecture): (.*)$", re.M)
+stanza_separator_re = re.compile(r"\n[ \t\r]*\n")
+
+"""
+Prefix of the names of the reprepro processincoming rules used to include
+queued packages
+"""
+incoming_rule_prefix = "globus-release-tools-"
+
+"""
+Prefix of the names of the temporary incoming directories created in a
+repository base directory by each processincoming run
+"""
+incoming_prefix = ".incoming-"
+
+"""
+Name of the file in a repository base directory which is locked while
+reprepro updates it
+"""
+lock_name = ".reprepro.lock"
+
+# Changes files queued by Repository.add_package, by repository base
+# directory. Each entry maps (codename, changes file name) to
+# (changes file path, destination path in the pool)
+_pending_includes = {}
+_pending_includes_lock = threading.Lock()
+
+
+def _stanzas(f, blocksize=1 << 20):
+    """
+    Iterate through the blank-line separated stanzas of the control file
+    *f*, reading it in blocks of *blocksize* bytes. Lines containing only
+    whitespace, including the carriage return of a CRLF line ending, also
+    separate stanzas
+    """
+    remainder = ""
+    while True:
+        block = f.read(blocksize)
+        if not block:
+            break
+        chunks = stanza_separator_re.split(remainder + block)
+        remainder = chunks.pop()
+        for chunk in chunks:
+            if chunk.strip() != "":
+                yield chunk
+    if remainder.strip() != "":
+        yield remainder
+
+
+def _read_changes(changes_path):
+    """
+    Return a tuple containing the Distribution field of the .changes file
+    at *changes_path* and the list of names of the files in its Files field
+    """
+    distribution = None
+    files = []
+    in_files = False
+    f = file(changes_path, "r")
+    try:
+        for line in f:
+            if in_files and line[:1] in (" ", "\t"):
+                fields = line.split()
+                if len(fields) == 5:
+                    files.append(fields[4])
+                continue
+            in_files = line.startswith("Files:")
+            m = distro_re.match(line)
+            if m is not None:
+                distribution = m.group(1)
+    finally:
+        f.close()
+    return (distribution, files)
+
+
+def _pool_signature(pooldir):
+    """
+    Return a hash of the modification times of the pool/contrib/<prefix>
+    and pool/contrib/<prefix>/<source> directories under *pooldir*, which
+    change whenever .changes files are added to or removed from the pool
+    """
+    digester = hashlib.sha1()
+    try:
+        prefixes = sorted(os.listdir(pooldir))
+    except OSError:
+        return None
+    for prefix in prefixes:
+        prefixdir = os.path.join(pooldir, prefix)
+        try:
+            sources = sorted(os.listdir(prefixdir))
+            digester.update("%s\0%r\n" % (
+                prefix, os.stat(prefixdir).st_mtime))
+            for source in sources:
+                digester.update("%s/%s\0%r\n" % (
+                    prefix, source,
+                    os.stat(os.path.join(prefixdir, source)).st_mtime))
+        except OSError:
+            continue
+    return digester.hexdigest()
+
+
+class PoolIndex(object):
+    """
+    PoolIndex class
+    ===============
+    Locates .changes files in the pool of a Debian repository. Each
+    pool/contrib/<prefix>/<source> directory is listed at most once, and
+    later lookups for files in it are answered from that listing.
+    """
+    def __init__(self, pooldir):
+        self.pooldir = pooldir
+        self.entries = {}
+
+    def path(self, changesfile):
+        """
+        Return the path in the pool where *changesfile* belongs
+        """
+        poolsubdir = changesfile[0:1]
+        if changesfile.startswith("lib"):
+            poolsubdir = changesfile[0:4]
+        return os.path.join(
+                self.pooldir,
+                poolsubdir,
+                changesfile.split("_", 1)[0],
+                changesfile)
+
+    def contains(self, changesfile):
+        """
+        Check whether *changesfile* is present in the pool
+        """
+        dirname = os.path.dirname(self.path(changesfile))
+        if dirname not in self.entries:
+            try:
+                self.entries[dirname] = set(os.listdir(dirname))
+            except OSError:
+                self.entries[dirname] = set()
+        return changesfile in self.entries[dirname]
 
 
 class Repository(repo.Repository):
@@ -38,7 +179,15 @@ class Repository(repo.Repository):
     from the release's Sources.gz file
     """
 
-    def __init__(self, repo_path, codename, arch):
+    def __init__(self, repo_path, codename, arch, pool_signature=None):
+        """
+        Load the package metadata of the *arch* architecture of the
+        *codename* distribution in the reprepro base directory *repo_path*.
+        The binary package paths are found from the .changes files in the
+        pool, so cached metadata is only used if the pool is unchanged:
+        *pool_signature* is the _pool_signature of the pool, computed here
+        if None.
+        """
         super(Repository, self).__init__()
         self.repo_path = repo_path
         self.codename = codename
@@ -48,7 +197,7 @@ class Repository(repo.Repository):
         distdir = os.path.join(repo_path, "dists", codename)
 
         if not os.path.exists(distdir):
-            self.update_metadata(True)
+            Repository.create_distributions(repo_path, [codename])
 
         packages_file = os.path.join(
             distdir, "contrib", "binary-%s" % (arch), "Packages.gz")
@@ -57,71 +206,60 @@ class Repository(repo.Repository):
             packages_file = os.path.join(
                 distdir, "contrib", arch, "Sources.gz")
 
-        pf = gzip.open(packages_file)
+        # The binary package paths depend on which .changes files are in
+        # the pool
+        if arch == 'source':
+            pool_signature = None
+        elif pool_signature is None:
+            pool_signature = _pool_signature(pooldir)
+
+        self._insert_packages(self._cached_packages(
+            packages_file,
+            lambda path: self.__parse_packages(path, pooldir, arch),
+            arch,
+            pool_signature))
+
+    def __parse_packages(self, packages_file, pooldir, arch):
+        """
+        Parse a Packages.gz or Sources.gz file and return a list of the
+        package metadata in it
+        """
+        packages = []
+        pool = PoolIndex(pooldir)
 
-        name = None
-        source = None
-        version = None
-        release = None
-        filename = None
-        pkgarch = None
-
-        for line in pf:
-            line = line.rstrip()
-
-            if line.startswith("Package: "):
-                name = line.split(": ", 1)[1]
-            elif line.startswith("Source: "):
-                source = line.split(": ", 1)[1]
-            elif line.startswith("Version: "):
-                version, release = line.strip().split(": ")[1].split("-", 1)
-            elif line.startswith("Filename: "):
-                filename = line.split(": ", 1)[1]
-            elif line.startswith("Architecture: "):
-                pkgarch = line.split(": ", 1)[1]
-            elif line == "":
-                if name not in self.packages:
-                    self.packages[name] = []
+        pf = gzip.open(packages_file)
+        try:
+            for stanza in _stanzas(pf):
+                fields = dict(
+                    (field, value.rstrip())
+                    for (field, value) in stanza_field_re.findall(stanza))
+                name = fields.get('Package')
+                if name is None:
+                    continue
+                source = fields.get('Source')
+                version, release = fields.get('Version').split("-", 1)
+                pkgarch = fields.get('Architecture')
 
                 if arch == 'source':
                     src = name + "_" + version
-                    suffix = "source"
-                    filename = "%s-%s_%s.changes" % (src, release, suffix)
-                    poolsubdir = filename[0:1]
-                    if filename.startswith("lib"):
-                        poolsubdir = filename[0:4]
-
-                    filepath = os.path.join(
-                            pooldir,
-                            poolsubdir,
-                            filename.split("_", 1)[0],
-                            filename)
-                    self.packages[name].append(
+                    packages.append(
                             repo.package.Metadata(
                                 name,
                                 version,
                                 release,
-                                filepath,
+                                pool.path("%s-%s_source.changes" % (
+                                    src, release)),
                                 'src',
                                 src,
                                 self.codename))
                     if pkgarch == 'all':
-                        suffix = "all"
-                        filename = "%s-%s_%s.changes" % (src, release, suffix)
-                        poolsubdir = filename[0:1]
-                        if filename.startswith("lib"):
-                            poolsubdir = filename[0:4]
-                        filepath = os.path.join(
-                                pooldir,
-                                poolsubdir,
-                                filename.split("_", 1)[0],
-                                filename)
-                        self.packages[name].append(
+                        packages.append(
                                 repo.package.Metadata(
                                     name,
                                     version,
                                     release,
-                                    filepath,
+                                    pool.path("%s-%s_all.changes" % (
+                                        src, release)),
                                     pkgarch,
                                     src,
                                     self.codename))
@@ -137,19 +275,11 @@ class Repository(repo.Repository):
                     for archcand in archcands:
                         changesfile = "%s-%s_%s.changes" % (
                             src, release, archcand)
-                        poolsubdir = changesfile[0:1]
-                        if changesfile.startswith("lib"):
-                            poolsubdir = changesfile[0:4]
-                        testfile = os.path.join(
-                                pooldir,
-                                poolsubdir,
-                                changesfile.split("_", 1)[0],
-                                changesfile)
-                        if os.path.exists(testfile):
-                            filepath = testfile
+                        if pool.contains(changesfile):
+                            filepath = pool.path(changesfile)
                             break
                     if filepath != "":
-                        self.packages[name].append(
+                        packages.append(
                                 repo.package.Metadata(
                                     name,
                                     version,
@@ -158,16 +288,10 @@ class Repository(repo.Repository):
                                     arch,
                                     src,
                                     self.codename))
+        finally:
+            pf.close()
 
-                name = None
-                source = None
-                version = None
-                release = None
-                filename = None
-                pkgarch = None
-
-        for n in self.packages:
-            self.packages[n].sort()
+        return packages
 
     def add_package(self, package, update_metadata=False):
         """
@@ -199,16 +323,9 @@ class Repository(repo.Repository):
                     os.chmod(dirname, 0o2775)
                     dirname = os.path.dirname(dirname)
         if not os.path.exists(dest_path):
-            oscmd = 'reprepro --silent -b %(repodir)s --export=never include %(codename)s %(pkgpath)s' % {
-                        'repodir': self.repo_path,
-                        'codename': self.codename,
-                        'pkgpath': package.path
-                    }
-            os.system(oscmd)
-            if update_metadata:
-                self.update_metadata()
-            else:
-                self.dirty = True
+            with _pending_includes_lock:
+                _pending_includes.setdefault(self.repo_path, {})[
+                    (self.codename, pkg_basename)] = (package.path, dest_path)
 
         # Create a new repo.package.Metadata with the new path
         new_package = repo.package.Metadata(
@@ -219,47 +336,192 @@ class Repository(repo.Repository):
                 package.source_name,
                 self.codename)
 
-        if package.name not in self.packages:
-            self.packages[package.name] = []
-        self.packages[package.name].append(new_package)
-        self.packages[package.name].sort()
+        self._insert_package(new_package)
+        self.dirty = True
         if update_metadata:
             self.update_metadata()
-        else:
-            self.dirty = True
         return new_package
 
-    def update_metadata(self, force):
+    def update_metadata(self, force=False):
+        """
+        Include the packages queued by add_package for this repository's
+        codename and update the package metadata from the changes files in
+        the repository. Returns a list of messages describing the failed
+        commands and the .changes files that reprepro failed to include.
+        """
+        return Repository.update_base_metadata([self], force)
+
+    @staticmethod
+    def update_base_metadata(repositories, force=False):
         """
-        Update the package metadata from the changes files in a repository
+        Update the metadata of the *repositories* which have changed (all of
+        them if *force* is True). The repositories must share one reprepro
+        base directory. The distributions configuration is updated once for
+        all of their codenames, the packages queued by add_package for those
+        codenames are included, and a single reprepro export regenerates the
+        indices of just those codenames.
+
+        Returns a list of messages describing the failed commands and the
+        .changes files that reprepro failed to include.
         """
-        if self.dirty or force:
-            confdir = os.path.join(self.repo_path, "conf")
-            distributions_file = os.path.join(confdir, "distributions")
+        changed = [r for r in repositories if r.dirty or force]
+        if not changed:
+            return []
+        repo_path = changed[0].repo_path
+        codenames = sorted(set(r.codename for r in changed))
+
+        confdir = os.path.join(repo_path, "conf")
+        distributions_file = os.path.join(confdir, "distributions")
 
-            if not os.path.exists(confdir):
-                os.makedirs(confdir, 0o755)
+        if not os.path.exists(confdir):
+            os.makedirs(confdir, 0o755)
 
+        with repo._locked(os.path.join(repo_path, lock_name)):
             Repository._update_deb_distributions_conf(
-                distributions_file, self.codename)
-            oscmd = 'reprepro --silent -b "%s" export' % (self.repo_path)
-            os.system(oscmd)
-            self.dirty = False
+                distributions_file, codenames)
+            failed = changed[0]._process_incoming(codenames)
+            repo._run_command(
+                ['reprepro', '--silent', '-b', repo_path, 'export'] +
+                codenames,
+                failed)
+        for r in changed:
+            r.dirty = False
+        return failed
 
     @staticmethod
-    def _update_deb_distributions_conf(conf_file_path, distro):
+    def create_distributions(repo_path, codenames):
+        """
+        Create the dists directories of the *codenames* which do not have
+        one yet in the reprepro base directory *repo_path*, with a single
+        update of its distributions configuration and a single reprepro
+        export. Raises an Exception if reprepro fails.
+        """
+        missing = [
+            codename for codename in codenames
+            if not os.path.exists(os.path.join(repo_path, "dists", codename))]
+        if not missing:
+            return
+
+        confdir = os.path.join(repo_path, "conf")
+        if not os.path.exists(confdir):
+            os.makedirs(confdir, 0o755)
+        with repo._locked(os.path.join(repo_path, lock_name)):
+            Repository._update_deb_distributions_conf(
+                os.path.join(confdir, "distributions"), missing)
+            failed = []
+            if not repo._run_command(
+                    ['reprepro', '--silent', '-b', repo_path, 'export'] +
+                    missing,
+                    failed):
+                raise Exception("Unable to create distributions", failed)
+
+    def _process_incoming(self, codenames):
+        """
+        Include the .changes files queued for the *codenames* in this
+        repository's base directory, with one reprepro processincoming run
+        for each codename.
+        The changes files and the files they list are linked into a
+        temporary incoming directory for each codename. The incoming rules
+        are written to a temporary configuration directory which links to
+        the rest of the repository's configuration. The caller must hold the
+        lock on the base directory's lock_name file. Returns a list of
+        messages describing the failed reprepro commands and the .changes
+        files which are not in the pool afterwards.
+        """
+        failed = []
+        pending = {}
+        with _pending_includes_lock:
+            queued = _pending_includes.get(self.repo_path, {})
+            for key in list(queued):
+                if key[0] in codenames:
+                    pending[key] = queued.pop(key)
+        if not pending:
+            return []
+
+        # The caller holds the lock of the base directory, so any incoming
+        # directories left now are from interrupted runs
+        for entry in os.listdir(self.repo_path):
+            if entry.startswith(incoming_prefix):
+                shutil.rmtree(os.path.join(self.repo_path, entry), True)
+
+        incoming_top = tempfile.mkdtemp(
+            prefix=incoming_prefix, dir=self.repo_path)
+        rules = {}
+        try:
+            for (codename, pkg_basename), (changes_path, dest_path) in \
+                    sorted(pending.items()):
+                incoming_dir = os.path.join(incoming_top, codename)
+                if not os.path.exists(incoming_dir):
+                    os.makedirs(incoming_dir)
+                distribution, files = _read_changes(changes_path)
+                rules.setdefault(codename, set()).add(distribution)
+                for name in [pkg_basename] + files:
+                    src = os.path.join(os.path.dirname(changes_path), name)
+                    dst = os.path.join(incoming_dir, name)
+                    if os.path.exists(dst):
+                        continue
+                    repo._copy_file(src, dst)
+
+            tmpdir = os.path.join(incoming_top, ".tmp")
+            if not os.path.exists(tmpdir):
+                os.makedirs(tmpdir)
+            conf = []
+            for codename in sorted(rules):
+                allow = [
+                    d if d == codename else d + ">" + codename
+                    for d in sorted(rules[codename]) if d is not None]
+                conf.append("Name: %s%s\n" % (incoming_rule_prefix, codename))
+                conf.append("IncomingDir: %s\n" % (
+                    os.path.join(incoming_top, codename)))
+                conf.append("TempDir: %s\n" % (tmpdir))
+                if allow:
+                    conf.append("Allow: %s\n" % (" ".join(allow)))
+                conf.append("Default: %s\n\n" % (codename))
+            # Use a private configuration directory with the generated
+            # incoming rules, so that the repository's own conf/incoming
+            # is left alone
+            confdir = os.path.join(incoming_top, ".conf")
+            os.mkdir(confdir)
+            repo_confdir = os.path.abspath(
+                os.path.join(self.repo_path, "conf"))
+            for entry in os.listdir(repo_confdir):
+                if entry != "incoming":
+                    os.symlink(
+                        os.path.join(repo_confdir, entry),
+                        os.path.join(confdir, entry))
+            repo._write_atomic(
+                os.path.join(confdir, "incoming"), "".join(conf), 0o644)
+
+            for codename in sorted(rules):
+                repo._run_command([
+                        'reprepro', '--silent', '-b', self.repo_path,
+                        '--confdir', confdir,
+                        '--export=never', 'processincoming',
+                        incoming_rule_prefix + codename],
+                    failed)
+        finally:
+            shutil.rmtree(incoming_top, True)
+
+        failed.extend([
+            "reprepro failed to include %s" % (changes_path)
+            for (changes_path, dest_path) in sorted(pending.values())
+            if not os.path.exists(dest_path)])
+        return failed
+
+    @staticmethod
+    def _update_deb_distributions_conf(conf_file_path, distros):
         """
         Update the +conf/distributions+ file at the specified path to contain
-        information about the named distribution if it is not present yet.
+        information about the named distributions which are not present yet.
 
         Parameters
         ----------
         *conf_file_path*::
             Path to the +conf/distributions+ to modify (str)
-        *distro*::
-            Distribution codename to add to 'conf_file_path' (str)
+        *distros*::
+            List of distribution codenames to add to 'conf_file_path'
         """
-        distribution_data = """
+        distribution_template = """
 Label: Globus Toolkit
 Codename: %s
 Architectures: amd64 i386 source
@@ -270,37 +532,78 @@ Contents: . .gz .bz2
 SignWith: yes
 Tracking: keep includechanges
 Description: Globus Toolkit Packages
-""" % (distro)
-        f = None
-        if not os.path.exists(conf_file_path):
-            f = file(conf_file_path, "w+")
-        else:
-            f = file(conf_file_path, "r+")
+"""
+        existing = ""
+        mode = 0o664
+        if os.path.exists(conf_file_path):
+            mode = os.stat(conf_file_path).st_mode & 0o7777
+            f = file(conf_file_path, "r")
+            try:
+                existing = f.read()
+            finally:
+                f.close()
 
-        for l in f:
+        present = set()
+        for l in existing.splitlines(True):
             cnm = codename_re.match(l)
-            if cnm is not None and cnm.group(1) == distro:
-                f.close()
-                return
+            if cnm is not None:
+                present.add(cnm.group(1))
 
-        f.write(distribution_data)
-        f.close()
+        missing = [distro for distro in distros if distro not in present]
+        if not missing:
+            return
+
+        # Replace the file rather than appending to it, so that reprepro
+        # never reads a partially written distribution
+        repo._write_atomic(
+            conf_file_path,
+            existing + "".join(
+                distribution_template % (distro) for distro in missing),
+            mode)
 
 
 class Release(repo.Release):
     def __init__(
             self, name, topdir, codenames=default_codenames,
-            arches=default_arches):
+            arches=default_arches, pool=None):
+        """
+        Create the Repository for each of the *arches* of each of the
+        *codenames*, using the optional thread *pool* to load them
+        concurrently. Missing distributions are created first, so that the
+        concurrent loads never modify the reprepro base directory.
+        """
+        Repository.create_distributions(topdir, codenames)
+        # All of the repositories share the pool, so check it only once
+        pool_signature = _pool_signature(
+            os.path.join(topdir, "pool", "contrib"))
+        jobs = [
+            (codename, arch) for codename in codenames for arch in arches]
+        repositories = repo._parallel_map(
+            lambda job: Repository(
+                topdir, job[0], job[1], pool_signature),
+            jobs, pool)
         r = {}
         for codename in codenames:
             r[codename] = {}
-            for arch in arches:
-                if arch == 'source':
-                    r[codename]['src'] = Repository(topdir, codename, arch)
-                else:
-                    r[codename][arch] = Repository(topdir, codename, arch)
+        for (codename, arch), repository in zip(jobs, repositories):
+            if arch == 'source':
+                r[codename]['src'] = repository
+            else:
+                r[codename][arch] = repository
         super(Release, self).__init__(name, r)
 
+    def update_metadata(
+            self, osname=None, arch=None, force=False, workers=None):
+        """
+        Update the metadata of this release's repositories for *osname* and
+        *arch* (all of them if None). All of the repositories share the
+        reprepro base directory of the release, so they are updated
+        together by a single reprepro and *workers* is not used. Returns a
+        list of messages describing the failed updates.
+        """
+        return Repository.update_base_metadata(
+            self.repositories_for_os_arch(osname, arch), force)
+
     def repositories_for_package(self, package):
         """
         Returns a list of repositories where the given package would belong.
@@ -327,7 +630,7 @@ class Manager(repo.Manager):
     def __init__(
             self, root=repo.default_root,
             releases=repo.default_releases, os_names=None,
-            exclude_os_names=None):
+            exclude_os_names=None, workers=None):
         """
         Constructor
         -----------
@@ -346,8 +649,10 @@ class Manager(repo.Manager):
             (Optional) List of operating system codenames (e.g. wheezy) to
             skip. If None, then all debian-based OSes will be managed. This is
             evaluated after os_names
+        *workers*::
+            (Optional) Number of threads used to load the repositories of all
+            releases concurrently. If None or 1, they are loaded serially.
         """
-        deb_releases = {}
 
         codenames = Manager.find_codenames(root, releases[0])
 
@@ -355,11 +660,14 @@ class Manager(repo.Manager):
             codenames = [cn for cn in codenames if cn in os_names]
         if exclude_os_names is not None:
             codenames = [cn for cn in codenames if cn not in exclude_os_names]
-        for release in releases:
-            deb_releases[release] = Release(
+        deb_releases = repo._load_releases(
+            releases,
+            lambda release, pool: Release(
                     release,
                     os.path.join(root, release, 'deb'),
-                    codenames)
+                    codenames,
+                    pool=pool),
+            workers)
         super(Manager, self).__init__(deb_releases)
 
     @staticmethod
@@ -19,7 +19,6 @@ Package to manage the installers repository
 import os
 import os.path
 import re
-import shutil
 
 import repo
 import repo.package
@@ -65,7 +64,7 @@ class Repository(repo.packages.Repository):
                     and pkg.version > new_package.version
             ]
             if len(latest_candidates) == 0:
-                shutil.copy(new_package.path, new_package_path)
+                repo._copy_file(new_package.path, new_package_path)
                 if update_metadata:
                     self.update_metadata(True)
 
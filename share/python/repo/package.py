@@ -16,49 +16,77 @@ import repo
 import repo.versioncompare
 
 
+def shared_string(s):
+    """
+    Return the interned copy of the string *s*, so that repeated names,
+    architectures, operating systems, and versions share one copy across
+    all parsed repositories. Strings which are not str are returned as is.
+    """
+    if type(s) is not str:
+        return s
+    return intern(s)
+
+
 class Version(object):
     """
     Version class to allow comparison of package versions, including
     release versions and wildcards for releases
     """
-    def __init__(self, version, release=None):
+    __slots__ = ('strversion', 'version', 'release', 'backend', '_key')
+
+    def __init__(self, version, release=None, backend=None):
         """
         Initialize with a version string and a release string. If the release
         string is None, acts as a wildcard that matches all releases of that
-        version
+        version. The optional *backend* names the
+        repo.versioncompare.backends entry used to compute the comparison
+        keys (repo.versioncompare.default_backend if None); only Versions
+        using the same backend can be compared.
         """
-        self.strversion = version
-        self.version = repo.versioncompare.version2float(version)
-        self.release = release
+        self.backend = backend or repo.versioncompare.default_backend
+        backend = self.backend
+        self.strversion = shared_string(version)
+        self.version = repo.versioncompare.version_key(version, backend)
+        self.release = shared_string(release)
         if self.release is None:
             self.release = "*"
+        self._key = (
+            self.version,
+            repo.versioncompare.release_key(self.release, backend))
+
+    def sort_key(self):
+        """
+        Return the immutable key this version is ordered by
+        """
+        return self._key
+
+    def __check_backend(self, other):
+        if self.backend != other.backend:
+            raise TypeError(
+                "Cannot compare %s versions with %s versions" % (
+                    self.backend, other.backend))
 
     def __lt__(self, other):
-        return (
-            (self.version < other.version)
-            or (
-                (self.version == other.version)
-                and repo.versioncompare.ReleaseGreater(
-                    other.release, self.release)))
+        self.__check_backend(other)
+        return self._key < other._key
 
     def __le__(self, other):
         return (self < other) or (self == other)
 
     def __eq__(self, other):
+        self.__check_backend(other)
         return (
             (self.version == other.version)
             and ((self.release == other.release)
                  or (self.release == '*') or (other.release == '*')))
 
     def __ne__(self, other):
+        self.__check_backend(other)
         return self.version != other.version or self.release != other.release
 
     def __gt__(self, other):
-        return (
-            (self.version > other.version)
-            or ((self.version == other.version)
-                and repo.versioncompare.ReleaseGreater(
-                    self.release, other.release)))
+        self.__check_backend(other)
+        return self._key > other._key
 
     def __ge__(self, other):
         return (self > other) or (self == other)
@@ -71,13 +99,21 @@ class Version(object):
 
 
 class Metadata(object):
+    __slots__ = ('name', 'version', 'path', 'arch', 'source_name', 'os')
+
     def __init__(self, name, version, release, path, arch, source, os):
-        self.name = name
+        self.name = shared_string(name)
         self.version = Version(version, release)
         self.path = path
-        self.arch = arch
-        self.source_name = source
-        self.os = os
+        self.arch = shared_string(arch)
+        self.source_name = shared_string(source)
+        self.os = shared_string(os)
+
+    def sort_key(self):
+        """
+        Return the immutable key this package is ordered by
+        """
+        return (self.name, self.version.sort_key())
 
     def __cmp__(self, other):
         c = cmp(self.name, other.name)
@@ -21,7 +21,6 @@ import os.path
 import re
 import repo
 import repo.package
-import shutil
 
 
 class Repository(repo.Repository):
@@ -40,7 +39,17 @@ class Repository(repo.Repository):
         if not os.path.exists(self.repo_path):
             self.update_metadata(True)
 
-        for tarball in os.listdir(self.repo_path):
+        self._insert_packages(self._cached_packages(
+            self.repo_path, self.__parse_listing,
+            name + "\0" + self.pkg_re.pattern))
+
+    def __parse_listing(self, repo_path):
+        """
+        Return a list of the package metadata for the files in *repo_path*
+        which match this repository's package regular expression
+        """
+        packages = []
+        for tarball in os.listdir(repo_path):
             m = self.pkg_re.match(tarball)
             if m is not None:
                 d = m.groupdict()
@@ -51,20 +60,15 @@ class Repository(repo.Repository):
                         os.path.join(repo_path, tarball),
                         d.get('arch', 'src'),
                         os.path.join(repo_path, tarball),
-                        name)
-                if pkg.name not in self.packages:
-                    self.packages[pkg.name] = []
-                self.packages[pkg.name].append(pkg)
-        for p in self.packages:
-            self.packages[p].sort()
+                        self.name)
+                packages.append(pkg)
+        return packages
 
     def add_package(self, package, update_metadata=False):
         dest_path = os.path.join(
             self.repo_path, os.path.basename(package.path))
         if not os.path.exists(dest_path):
-            shutil.copy(package.path, dest_path)
-        if package.name not in self.packages:
-            self.packages[package.name] = []
+            repo._copy_file(package.path, dest_path)
 
         # Create a new repo.package.Metadata with the new path
         new_package = repo.package.Metadata(
@@ -75,8 +79,7 @@ class Repository(repo.Repository):
                 package.source_name,
                 'src')
 
-        self.packages[package.name].append(new_package)
-        self.packages[package.name].sort()
+        self._insert_package(new_package)
         if update_metadata:
             self.update_metadata()
         else:
@@ -85,7 +88,11 @@ class Repository(repo.Repository):
 
     def update_metadata(self, force=False):
         """
-        Update the checksums for the packages in this repository
+        Update the checksums for the packages in this repository. Missing
+        checksum files are always written. If *force* is True, those of
+        packages which have changed since they were last hashed are
+        rewritten as well. Returns an empty list, as there are no external
+        commands to fail.
         """
         if self.dirty or force:
             distro_repodir = self.repo_path
@@ -96,10 +103,14 @@ class Repository(repo.Repository):
                     os.chown(distro_repodir, repo.uid, repo.gid)
                     os.chmod(distro_repodir, 0o2775)
 
-            for pkg in os.listdir(distro_repodir):
-                pkg_filename = os.path.join(distro_repodir, pkg)
-                if os.path.isfile(pkg_filename):
-                    repo._digest_file(pkg_filename)
+            repo._digest_files([
+                pkg_filename
+                for pkg_filename in [
+                    os.path.join(distro_repodir, pkg)
+                    for pkg in os.listdir(distro_repodir)]
+                if os.path.isfile(pkg_filename)], force)
+            repo.save_digest_manifests()
+        return []
 
     def update_gcs_version_file(self):
         """
@@ -0,0 +1,154 @@
+# Copyright 2014-2015 University of Chicago
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pure-Python reader for the lead and headers of RPM package files, used to
+generate repository metadata without the rpm tools
+"""
+
+import struct
+
+LEAD_MAGIC = b"\xed\xab\xee\xdb"
+HEADER_MAGIC = b"\x8e\xad\xe8\x01"
+LEAD_SIZE = 96
+
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_EPOCH = 1003
+RPMTAG_SUMMARY = 1004
+RPMTAG_DESCRIPTION = 1005
+RPMTAG_BUILDTIME = 1006
+RPMTAG_SIZE = 1009
+RPMTAG_LICENSE = 1014
+RPMTAG_GROUP = 1016
+RPMTAG_ARCH = 1022
+RPMTAG_SOURCERPM = 1044
+RPMTAG_PROVIDENAME = 1047
+RPMTAG_REQUIREFLAGS = 1048
+RPMTAG_REQUIRENAME = 1049
+RPMTAG_REQUIREVERSION = 1050
+RPMTAG_CONFLICTFLAGS = 1053
+RPMTAG_CONFLICTNAME = 1054
+RPMTAG_CONFLICTVERSION = 1055
+RPMTAG_OBSOLETENAME = 1090
+RPMTAG_PROVIDEFLAGS = 1112
+RPMTAG_PROVIDEVERSION = 1113
+RPMTAG_OBSOLETEFLAGS = 1114
+RPMTAG_OBSOLETEVERSION = 1115
+
+RPMSENSE_LESS = 0x02
+RPMSENSE_GREATER = 0x04
+RPMSENSE_EQUAL = 0x08
+RPMSENSE_PREREQ = 0x40
+RPMSENSE_SCRIPT_PRE = 0x200
+RPMSENSE_SCRIPT_POST = 0x400
+RPMSENSE_RPMLIB = 0x1000000
+
+RPM_INT8_TYPE = 2
+RPM_INT16_TYPE = 3
+RPM_INT32_TYPE = 4
+RPM_INT64_TYPE = 5
+RPM_STRING_TYPE = 6
+RPM_BIN_TYPE = 7
+RPM_STRING_ARRAY_TYPE = 8
+RPM_I18NSTRING_TYPE = 9
+
+# Integer tags are unsigned: sizes and times can exceed 2**31 and the
+# dependency flags use the high bits
+__int_formats = {
+    RPM_INT8_TYPE: ("B", 1),
+    RPM_INT16_TYPE: ("H", 2),
+    RPM_INT32_TYPE: ("I", 4),
+    RPM_INT64_TYPE: ("Q", 8),
+}
+
+
+def __read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise Exception("Truncated RPM header", f.name)
+    return data
+
+
+def __read_header(f, tags):
+    """
+    Read one header structure from the file object *f*, positioned at the
+    header magic, and return a dict mapping the tag numbers in *tags* to
+    their values. Returns the number of bytes read along with the dict.
+    """
+    intro = __read_exactly(f, 16)
+    if intro[:4] != HEADER_MAGIC:
+        raise Exception("Bad RPM header magic", f.name)
+    (nindex, hsize) = struct.unpack(">II", intro[8:])
+    index = __read_exactly(f, 16 * nindex)
+    store = __read_exactly(f, hsize)
+
+    values = {}
+    for i in range(nindex):
+        (tag, tagtype, offset, count) = struct.unpack(
+                ">iiii", index[16*i:16*i+16])
+        if tag not in tags:
+            continue
+        if tagtype in __int_formats:
+            (fmt, size) = __int_formats[tagtype]
+            values[tag] = list(struct.unpack(
+                ">%d%s" % (count, fmt), store[offset:offset + size * count]))
+        elif tagtype == RPM_BIN_TYPE:
+            values[tag] = store[offset:offset + count]
+        elif tagtype in (
+                RPM_STRING_TYPE, RPM_STRING_ARRAY_TYPE, RPM_I18NSTRING_TYPE):
+            strings = []
+            for j in range(count):
+                end = store.index(b"\0", offset)
+                strings.append(store[offset:end])
+                offset = end + 1
+            if tagtype == RPM_STRING_ARRAY_TYPE:
+                values[tag] = strings
+            else:
+                # The first entry of an I18N string is the C locale one
+                values[tag] = strings[0]
+    return (16 + 16 * nindex + hsize, values)
+
+
+def read_header(path, tags):
+    """
+    Read the main header of the RPM package at *path*
+
+    Parameters
+    ----------
+    *path*::
+        Path to the RPM package file
+    *tags*::
+        Set of the tag numbers to return
+
+    Returns
+    -------
+    A dict mapping tag numbers to their values: a list of ints for integer
+    tags, a str for string and binary tags and a list of str for string
+    array tags. Tags not present in the header are omitted.
+    """
+    f = open(path, "rb")
+    try:
+        if __read_exactly(f, LEAD_SIZE)[:4] != LEAD_MAGIC:
+            raise Exception("Bad RPM lead magic", path)
+        # The signature header is padded to an 8 byte boundary
+        (sigsize, _) = __read_header(f, ())
+        if sigsize % 8:
+            __read_exactly(f, 8 - sigsize % 8)
+        return __read_header(f, tags)[1]
+    finally:
+        f.close()
+
+# vim: filetype=python:
@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import re
+import threading
 
 """
 Version comparison routines to deal with software version numbers, such as
@@ -20,6 +22,47 @@ Version comparison routines to deal with software version numbers, such as
 
 """
 
+gsissh_re = re.compile(r"(\d+).(\d+)p(\d+)-(\d{8})([a-z]?)")
+patch_re = re.compile(r'p(\d+)([a-z])?')
+release_re = re.compile(r"([0-9.]*)(.*)", re.S)
+
+"""
+Maximum number of parsed version and release strings kept by the key caches
+"""
+key_cache_size = 65536
+
+
+class _KeyCache(object):
+    """
+    Bounded least-recently-used cache mapping version or release strings to
+    their parsed comparison keys
+    """
+    def __init__(self, func, maxsize):
+        self.func = func
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def __call__(self, s):
+        with self.lock:
+            try:
+                key = self.entries.pop(s)
+            except KeyError:
+                pass
+            else:
+                self.entries[s] = key
+                return key
+        key = self.func(s)
+        with self.lock:
+            self.entries[s] = key
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return key
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
 
 def __v2fhelper(v, suff, version, weight):
     parts = v.split(suff)
@@ -30,13 +73,20 @@ def __v2fhelper(v, suff, version, weight):
     return parts[0]
 
 
-def version2float(v):
-    """
-    Convert a Mozilla-style version string into a floating-point number
-    1.2.3.4, 1.2a5, 2.3.4b1pre, 3.0rc2, etc
+def __number(s):
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
 
-    Or, convert an OpenSSH-portable version string with gsissh date+letter
-    Or, convert a gridftp-blackpearl-dsi version string with version._BETA
+
+def __version_components(v):
+    """
+    Split a version string into its numeric components. Returns a tuple
+    (gsissh, components), where gsissh is True for an OpenSSH-portable
+    version string and components is the list [major, minor, patch, date,
+    letter] in that case, or the list [4-part numerical revision, alpha, beta
+    or rc weight, alpha, beta or rc revision, pre weight] otherwise.
     """
     version = [
         0, 0, 0, 0,         # 4-part numerical revision
@@ -45,29 +95,26 @@ def version2float(v):
         1                   # Pre or (default) final
     ]
 
-    if v == 'latest':
-        return 1000.0
-
     parts = v.split("pre")
     if 2 == len(parts):
         version[6] = 0
         v = parts[0]
 
-    ver = 0
-    m = re.match(r"(\d+).(\d+)p(\d+)-(\d{8})([a-z]?)", v, 0)
+    m = gsissh_re.match(v)
     if m is not None:
         # Assume gsi-openssh style:
         # OpenSSH Portable version + date + optional letter version
-        if m is not None:
-            ver = float(m.group(1))
-            ver += float(m.group(2)) / 100.
-            ver += float(m.group(3)) / 10000.
-            ver += float(m.group(4)) / 1000000000000.
-            if m.group(5) != "":
-                letterval = ord(m.group(5)) - ord('a') + 1
-                ver += float(letterval) / 100000000000000.
+        letterval = 0
+        if m.group(5) != "":
+            letterval = ord(m.group(5)) - ord('a') + 1
+        return (True, [
+            __number(m.group(1)),
+            __number(m.group(2)),
+            __number(m.group(3)),
+            __number(m.group(4)),
+            letterval])
     else:
-        m = re.search(r'p(\d+)([a-z])?', v)
+        m = patch_re.search(v)
         if ".beta" in v:
             v = __v2fhelper(v, ".beta", version, 2)
         elif "beta" in v:
@@ -94,6 +141,32 @@ def version2float(v):
         parts = v.split(".")[:4]
         for (p, i) in zip(parts, range(len(parts))):
             version[i] = p
+        return (False, [__number(c) for c in version])
+
+
+def version2float(v):
+    """
+    Convert a Mozilla-style version string into a floating-point number
+    1.2.3.4, 1.2a5, 2.3.4b1pre, 3.0rc2, etc
+
+    Or, convert an OpenSSH-portable version string with gsissh date+letter
+    Or, convert a gridftp-blackpearl-dsi version string with version._BETA
+
+    Components of 100 or more, such as date stamps, overlap with the next
+    component in this encoding. See version2tuple for an exact ordering.
+    """
+    if v == 'latest':
+        return 1000.0
+
+    gsissh, version = __version_components(v)
+    if gsissh:
+        ver = float(version[0])
+        ver += float(version[1]) / 100.
+        ver += float(version[2]) / 10000.
+        ver += float(version[3]) / 1000000000000.
+        if version[4] != 0:
+            ver += float(version[4]) / 100000000000000.
+    else:
         ver = float(version[0])
         ver += float(version[1]) / 100.
         ver += float(version[2]) / 10000.
@@ -104,14 +177,111 @@ def version2float(v):
     return ver
 
 
+def version2tuple(v):
+    """
+    Convert a version string accepted by version2float into a tuple of
+    numbers which orders exactly, regardless of the size of each component.
+    Both layouts share the first three positions (major, minor, patch).
+    OpenSSH-portable versions are laid out as a final release of their
+    major, minor, and patch version, followed by their date and letter, so
+    that they order after that release as they do with version2float.
+    """
+    if v == 'latest':
+        return (1000,)
+
+    gsissh, version = __version_components(v)
+    if gsissh:
+        return (
+            version[0], version[1], version[2], 0, 4, 0, 1,
+            version[3], version[4])
+    else:
+        return tuple(version) + (0, 0)
+
+
+"""
+Version key functions by backend name. The 'float' backend is the original
+floating-point encoding, the 'tuple' backend orders components exactly.
+"""
+backends = {
+    'float': version2float,
+    'tuple': version2tuple,
+}
+
+"""
+Key of a release string with no leading numeric part, by backend name
+"""
+empty_release_keys = {
+    'float': 0.0,
+    'tuple': (),
+}
+
+"""
+Backend used when none is passed to version_key, release_key, or sort_key.
+The 'tuple' backend orders the same as 'float' wherever the float encoding
+is exact; run tests/test_versioncompare.py with GLOBUS_RELEASE_TOOLS_TEST_ROOT
+set to a release tree to check that before selecting it.
+"""
+default_backend = 'float'
+
+
+def __release_keyfunc(version_func, empty_key):
+    def release_keyfunc(r):
+        m = release_re.match(r)
+        accum, rest = m.group(1), m.group(2)
+        if len(accum) > 0 and accum[-1] == '.':
+            accum = accum[:-1]
+        if accum != "":
+            return (version_func(accum), rest)
+        else:
+            return (empty_key, rest)
+    return release_keyfunc
+
+
+__version_keys = dict(
+    (name, _KeyCache(func, key_cache_size))
+    for name, func in backends.items())
+__release_keys = dict(
+    (name, _KeyCache(
+        __release_keyfunc(func, empty_release_keys[name]), key_cache_size))
+    for name, func in backends.items())
+
+
+def version_key(version, backend=None):
+    """
+    Return the memoized comparison key for a version string, using the named
+    *backend* (default_backend if None).
+    """
+    return __version_keys[backend or default_backend](version)
+
+
+def release_key(release, backend=None):
+    """
+    Return the memoized comparison key for a release string (numeric until
+    the first non-number, followed by the rest of the string), using the
+    named *backend* (default_backend if None).
+    """
+    return __release_keys[backend or default_backend](release)
+
+
+def sort_key(version, release=None, backend=None):
+    """
+    Return an immutable key for *version* and *release* which orders the
+    same way as repo.package.Version objects. A *release* of None is treated
+    as the wildcard release '*'.
+    """
+    if release is None:
+        release = "*"
+    return (version_key(version, backend), release_key(release, backend))
+
+
 def ProgramVersionGreater(ver1, ver2):
     """
     Return True if ver1 > ver2 using semantics of comparing version
     numbers
     """
-    v1f = version2float(ver1)
-    v2f = version2float(ver2)
-    return v1f == 1000.0 or v1f > v2f
+    v1k = version_key(ver1)
+    v2k = version_key(ver2)
+    return v1k == version_key('latest') or v1k > v2k
 
 
 def ReleaseGreater(ver1, ver2):
@@ -121,42 +291,6 @@ def ReleaseGreater(ver1, ver2):
     """
     if ver1 is None or ver2 is None:
         return
-    accum1 = ""
-    rest1 = ""
-    for r in range(len(ver1)):
-        dig = ver1[r]
-        if dig.isdigit() or dig == '.':
-            accum1 += dig
-        else:
-            rest1 = ver1[r:]
-            break
-    accum2 = ""
-    rest2 = ""
-    for r in range(len(ver2)):
-        dig = ver2[r]
-        if dig.isdigit() or dig == '.':
-            accum2 += dig
-        else:
-            rest2 = ver2[r:]
-            break
-
-    if len(accum1) > 0 and accum1[-1] == '.':
-        accum1 = accum1[:-1]
-    if len(accum2) > 0 and accum2[-1] == '.':
-        accum2 = accum2[:-1]
-    a1f = 0.0
-    a2f = 0.0
-
-    if accum1 != "":
-        a1f = version2float(accum1)
-    if accum2 != "":
-        a2f = version2float(accum2)
-
-    if a1f > a2f:
-        return True
-    elif a2f > a1f:
-        return False
-    else:
-        return rest1 > rest2
+    return release_key(ver1) > release_key(ver2)
 
 # vim: filetype=python:
@@ -16,18 +16,31 @@
 Package to manage the Globus Toolkit Yum repositories
 """
 
-import xml.etree.ElementTree as ET
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+import bz2
 import gzip
+import hashlib
 import os
 import os.path
 import re
 import shutil
 import sqlite3
+import tempfile
+import threading
 from subprocess import Popen, PIPE
 
 import repo
 import repo.package
 
+"""
+Name of the file in a repository directory which is locked while its
+metadata is staged
+"""
+lock_name = ".repodata.lock"
+
 """
 Current set of yum repositories as of 2014-08-27
 """
@@ -39,6 +52,27 @@ default_yum_repos = {
             "fedora/25":  ["i386", "SRPMS", "x86_64"]
 }
 
+_createrepo_version = None
+_createrepo_version_lock = threading.Lock()
+
+
+def _get_createrepo_version():
+    """
+    Return the (major, minor, patch) version tuple of the createrepo
+    program. The program is only run the first time this is called.
+    """
+    global _createrepo_version
+
+    with _createrepo_version_lock:
+        if _createrepo_version is None:
+            out, err = Popen(
+                ['createrepo', '--version'],
+                stdout=PIPE).communicate()
+            matches = re.search(r"(\d+).(\d+).(\d+)", out)
+            _createrepo_version = tuple(
+                [int(matches.group(i)) for i in range(1, 4)])
+    return _createrepo_version
+
 
 class Repository(repo.Repository):
     """
@@ -74,78 +108,147 @@ class Repository(repo.Repository):
                     location = data.find(Repository.repolocationtag)
                     return os.path.join(repodir, location.attrib['href'])
 
-    def __parse_primary_xml(self, xmlpath):
+    def __iter_primary_xml(self, xmlpath):
+        """
+        Incrementally parse a primary.xml.gz file, yielding the metadata for
+        each package as its element is completed. Processed elements are
+        discarded, so memory use does not grow with the size of the file.
+        """
         f = gzip.open(xmlpath, 'rb')
-        tree = ET.fromstring(f.read())
-        f.close()
-        packages = dict()
-
-        for package in tree:
-            packagename = package.find(Repository.nametag).text
-            v = package.find(Repository.versiontag)
-            packagever = v.attrib['ver']
-            packagerel = v.attrib['rel']
-            packagehref = package.find(Repository.locationtag).attrib['href']
-            packagepath = os.path.join(self.repo_path, packagehref)
-            packagearch = package.find(Repository.archtag).text
-            formatel = package.find(Repository.formattag)
-            pkgsourceel = formatel.find(Repository.sourcerpmtag)
-            pkgsource = None
-            if pkgsourceel is not None:
-                pkgsource = pkgsourceel.text
-            if pkgsource is None or pkgsource == '':
-                pkgsource = "-".join([packagename, packagever, packagerel]) \
-                        + ".src.rpm"
-            if packagename not in packages:
-                packages[packagename] = []
-            packages[packagename].append(repo.package.Metadata(
-                packagename,
-                packagever,
-                packagerel,
-                packagepath,
-                packagearch,
-                pkgsource,
-                self.os))
+        try:
+            root = None
+            for event, element in ET.iterparse(f, events=("start", "end")):
+                if root is None:
+                    root = element
+                if event != "end" or element.tag != Repository.pkgtag:
+                    continue
+                packagename = element.find(Repository.nametag).text
+                v = element.find(Repository.versiontag)
+                packagever = v.attrib['ver']
+                packagerel = v.attrib['rel']
+                packagehref = element.find(
+                    Repository.locationtag).attrib['href']
+                packagepath = os.path.join(self.repo_path, packagehref)
+                packagearch = element.find(Repository.archtag).text
+                formatel = element.find(Repository.formattag)
+                pkgsourceel = formatel.find(Repository.sourcerpmtag)
+                pkgsource = None
+                if pkgsourceel is not None:
+                    pkgsource = pkgsourceel.text
+                if pkgsource is None or pkgsource == '':
+                    pkgsource = "-".join(
+                        [packagename, packagever, packagerel]) + ".src.rpm"
+                yield repo.package.Metadata(
+                    packagename,
+                    packagever,
+                    packagerel,
+                    packagepath,
+                    packagearch,
+                    pkgsource,
+                    self.os)
+                root.clear()
+        finally:
+            f.close()
 
-        return packages
+    def __parse_primary_xml(self, xmlpath):
+        return list(self.__iter_primary_xml(xmlpath))
+
+    @staticmethod
+    def __bunzip2(src, dest):
+        """
+        Decompress the bzip2 file *src* into a temporary file next to
+        *dest*, then rename it to *dest*
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(dest), prefix=".tmp.")
+        try:
+            out = os.fdopen(fd, "wb")
+            try:
+                f = open(src, "rb")
+                try:
+                    decompressor = bz2.BZ2Decompressor()
+                    for block in iter(lambda: f.read(1 << 20), b""):
+                        while block:
+                            try:
+                                out.write(decompressor.decompress(block))
+                            except EOFError:
+                                # Start over for concatenated bzip2 streams
+                                decompressor = bz2.BZ2Decompressor()
+                                continue
+                            block = decompressor.unused_data
+                            if block:
+                                decompressor = bz2.BZ2Decompressor()
+                finally:
+                    f.close()
+            finally:
+                out.close()
+            os.rename(tmp_path, dest)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    @staticmethod
+    def __connect_readonly(dbpath):
+        """
+        Open the sqlite database at *dbpath* for reading. The Python 2
+        sqlite3 module cannot open URIs such as "file:...?mode=ro", so the
+        connection is made read-only with PRAGMA query_only instead.
+        """
+        conn = sqlite3.connect(dbpath)
+        conn.execute("PRAGMA query_only = 1")
+        conn.execute("PRAGMA cache_size = -65536")
+        # Return str rather than unicode, like the XML parser, so the
+        # strings can be interned
+        conn.text_factory = str
+        return conn
 
     def __parse_primary_db(self, dbpath):
-        packages = dict()
-        dbpath_uncompressed = dbpath.replace(".bz2", "")
-        if (not os.path.exists(dbpath_uncompressed)) or \
-                os.path.getmtime(dbpath_uncompressed) <= \
-                os.path.getmtime(dbpath):
-            os.system(
-                'bzip2 -dc < "%s" > "%s"' % (dbpath, dbpath_uncompressed))
-        conn = sqlite3.connect(dbpath_uncompressed)
-        cur = conn.cursor()
-        c = cur.execute("""
-            select name, version, release, location_href, arch,
-                   rpm_sourcerpm from packages""")
-        for name, ver, rel, href, arch, source in c:
-            packagename = str(name)
-            packagever = ver
-            packagerel = rel
-            packagehref = href
-            packagepath = os.path.join(self.repo_path, packagehref)
-            packagearch = arch
-            pkgsource = None
-            if source is not None:
-                pkgsource = source
-            if source is None or source == '':
-                pkgsource = "-".join([packagename, packagever, packagerel]) \
-                        + ".src.rpm"
-            if packagename not in packages:
-                packages[packagename] = []
-            packages[packagename].append(repo.package.Metadata(
-                packagename,
-                packagever,
-                packagerel,
-                packagepath,
-                packagearch,
-                pkgsource,
-                self.os))
-        conn.close()
+        """
+        Parse the bzip2-compressed primary_db at *dbpath* and return a list
+        of the package metadata in it. The database is decompressed to a
+        scratch file which is removed afterwards, as the parsed result is
+        what gets cached.
+        """
+        packages = []
+        fd, dbpath_uncompressed = tempfile.mkstemp(
+            dir=os.path.dirname(repo._scratch_path("yum", "")),
+            prefix="primary.", suffix=".sqlite")
+        os.close(fd)
+        try:
+            Repository.__bunzip2(dbpath, dbpath_uncompressed)
+            conn = Repository.__connect_readonly(dbpath_uncompressed)
+            cur = conn.cursor()
+            cur.execute("""
+                select name, version, release, location_href, arch,
+                       rpm_sourcerpm from packages""")
+            rows = cur.fetchmany(1000)
+            while rows:
+                for name, ver, rel, href, arch, source in rows:
+                    packagename = str(name)
+                    packagever = ver
+                    packagerel = rel
+                    packagehref = href
+                    packagepath = os.path.join(self.repo_path, packagehref)
+                    packagearch = arch
+                    pkgsource = None
+                    if source is not None:
+                        pkgsource = source
+                    if source is None or source == '':
+                        pkgsource = "-".join(
+                            [packagename, packagever, packagerel]) + \
+                            ".src.rpm"
+                    packages.append(repo.package.Metadata(
+                        packagename,
+                        packagever,
+                        packagerel,
+                        packagepath,
+                        packagearch,
+                        pkgsource,
+                        self.os))
+                rows = cur.fetchmany(1000)
+            conn.close()
+        finally:
+            os.remove(dbpath_uncompressed)
 
         return packages
 
@@ -164,14 +267,14 @@ class Repository(repo.Repository):
                     os.chmod(dirname, 0o2775)
                     dirname = os.path.dirname(dirname)
 
-        out, err = Popen(
-            ['createrepo', '--version'],
-            stdout=PIPE).communicate()
-        matches = re.search(r"(\d+).(\d+).(\d+)", out)
-        if int(matches.group(1)) >= 1 or int(matches.group(2)) >= 9:
+        createrepo_version = _get_createrepo_version()
+        if createrepo_version[0] >= 1 or createrepo_version[1] >= 9:
             self.use_sha_arg = True
         else:
             self.use_sha_arg = False
+        # Paths of the RPMs copied in by add_package since the metadata was
+        # last updated
+        self.added = set()
 
         try:
             primary_path = Repository.__get_primary_path(self.repo_path, xml)
@@ -179,20 +282,24 @@ class Repository(repo.Repository):
             self.__createrepo()
             primary_path = Repository.__get_primary_path(self.repo_path, xml)
 
+        if primary_path is None and not xml:
+            # No sqlite database (createrepo --no-database), parse the XML
+            xml = True
+            primary_path = Repository.__get_primary_path(self.repo_path, xml)
+
         if xml:
-            self.packages = self.__parse_primary_xml(primary_path)
+            self._insert_packages(self._cached_packages(
+                primary_path, self.__parse_primary_xml, "primary"))
         else:
-            self.packages = self.__parse_primary_db(primary_path)
-        for package in self.packages:
-            self.packages[package].sort()
+            self._insert_packages(self._cached_packages(
+                primary_path, self.__parse_primary_db, "primary_db"))
 
     def add_package(self, package, update_metadata=False):
         dest_rpm_path = os.path.join(
             self.repo_path, os.path.basename(package.path))
         if not os.path.exists(dest_rpm_path):
-            shutil.copy(package.path, dest_rpm_path)
-        if package.name not in self.packages:
-            self.packages[package.name] = []
+            repo._copy_file(package.path, dest_rpm_path)
+            self.added.add(dest_rpm_path)
 
         # Create a new repo.package.Metadata with the new path
         new_package = repo.package.Metadata(
@@ -203,24 +310,147 @@ class Repository(repo.Repository):
                 package.source_name,
                 self.os)
 
-        self.packages[package.name].append(new_package)
-        self.packages[package.name].sort()
+        self._insert_package(new_package)
         if update_metadata:
-            self.__createrepo()
+            self.__createrepo(incremental=True)
         else:
             self.dirty = True
         return new_package
 
     def update_metadata(self, force=False):
+        """
+        Run createrepo for this repository if it has changed or *force* is
+        True. Returns a list of messages describing the failed commands.
+        """
+        failures = []
         if force or self.dirty:
-            self.__createrepo()
+            failures = self.__createrepo(incremental=not force)
             self.dirty = False
+        return failures
 
-    def __createrepo(self):
+    def __createrepo(self, incremental=False):
+        """
+        Generate the repository metadata. If *incremental* is True and the
+        repository already has metadata, createrepo reuses the entries for
+        the RPMs it lists and only reads new or changed RPMs, caching their
+        checksums in the cache_dir. If add_package copied RPMs into the
+        repository, the RPMs already in the metadata are not checked for
+        changes, and createrepo is given the list of RPMs in the directory.
+        Otherwise all of the metadata is regenerated. Returns a list of
+        messages describing the failed commands.
+        """
+        failures = []
+        args = ['createrepo', '-d']
+        pkglist = None
         if '/el/5' in self.repo_path and self.use_sha_arg:
-            os.system('createrepo -d "%s" -s sha' % (self.repo_path))
-        else:
-            os.system('createrepo -d "%s"' % (self.repo_path))
+            args.extend(['-s', 'sha'])
+        if incremental and self.use_sha_arg and os.path.exists(
+                os.path.join(self.repo_path, "repodata", "repomd.xml")):
+            args.append('--update')
+            checksum_cache = repo._cache_path(
+                "createrepo", hashlib.sha1(
+                    os.path.abspath(self.repo_path)).hexdigest(), "")
+            if checksum_cache is not None:
+                args.extend(['--cachedir', checksum_cache])
+            if self.added:
+                args.append('--skip-stat')
+                pkglist = self.__write_pkglist()
+                args.extend(['--pkglist', pkglist])
+        try:
+            repodata = os.path.join(self.repo_path, "repodata")
+            if repo.stage_metadata and os.path.exists(
+                    os.path.join(repodata, "repomd.xml")):
+                self.__createrepo_staged(args, failures)
+            else:
+                args.append(self.repo_path)
+                repo._run_command(args, failures)
+        finally:
+            if pkglist is not None:
+                os.remove(pkglist)
+        self.added.clear()
+        return failures
+
+    def __write_pkglist(self):
+        """
+        Write the paths, relative to the repository directory, of all of the
+        RPMs in the repository directory to a temporary file for createrepo
+        --pkglist, and return its path. createrepo includes only the files
+        in the list, so the list comes from the directory itself: RPMs which
+        are missing from the current metadata, such as ones copied in by
+        hand or left by a failed run, are still included.
+        """
+        paths = []
+        for (dirpath, dirnames, filenames) in os.walk(self.repo_path):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            paths.extend([
+                os.path.relpath(os.path.join(dirpath, filename),
+                                self.repo_path)
+                for filename in filenames
+                if filename.endswith(".rpm") and not filename.startswith(".")])
+        fd, pkglist = tempfile.mkstemp(
+            dir=self.repo_path, prefix=".pkglist.")
+        f = os.fdopen(fd, "w")
+        try:
+            for path in sorted(paths):
+                f.write(path + "\n")
+        finally:
+            f.close()
+        return pkglist
+
+    def __createrepo_staged(self, args, failures):
+        """
+        Run createrepo with the command-line *args*, writing the metadata to
+        a staging directory seeded with links to the current metadata, and
+        then move it into the repodata directory. If createrepo fails, a
+        message is appended to *failures* and the metadata is left alone.
+        The new data files are moved in first and repomd.xml, which refers
+        to them, last, so clients always see a consistent repository. The
+        repository's lock_name file is locked while this runs, so only one
+        process at a time stages metadata for it.
+        """
+        repodata = os.path.join(self.repo_path, "repodata")
+        stage_prefix = ".repodata-stage."
+
+        with repo._locked(os.path.join(self.repo_path, lock_name)):
+            # While the lock is held, any other staging directories are
+            # from interrupted runs
+            for entry in os.listdir(self.repo_path):
+                if entry.startswith(stage_prefix):
+                    shutil.rmtree(os.path.join(self.repo_path, entry), True)
+
+            stage = tempfile.mkdtemp(prefix=stage_prefix, dir=self.repo_path)
+            try:
+                stage_repodata = os.path.join(stage, "repodata")
+                os.mkdir(stage_repodata)
+                for entry in os.listdir(repodata):
+                    os.link(
+                        os.path.join(repodata, entry),
+                        os.path.join(stage_repodata, entry))
+                if self.use_sha_arg:
+                    # Data files with the same names as the published ones
+                    # would be replaced before repomd.xml
+                    args = args + ['--unique-md-filenames']
+                if not repo._run_command(
+                        args + ['-o', stage, self.repo_path], failures):
+                    return
+                new_entries = os.listdir(stage_repodata)
+                if "repomd.xml" not in new_entries:
+                    failures.append("createrepo did not write %s" % (
+                        os.path.join(stage_repodata, "repomd.xml")))
+                    return
+                for entry in new_entries:
+                    if entry != "repomd.xml":
+                        os.rename(
+                            os.path.join(stage_repodata, entry),
+                            os.path.join(repodata, entry))
+                os.rename(
+                    os.path.join(stage_repodata, "repomd.xml"),
+                    os.path.join(repodata, "repomd.xml"))
+                for entry in os.listdir(repodata):
+                    if entry not in new_entries:
+                        os.remove(os.path.join(repodata, entry))
+            finally:
+                shutil.rmtree(stage, True)
 
 
 class Release(repo.Release):
@@ -230,15 +460,26 @@ class Release(repo.Release):
     Each Release contains a collection of repositories for different
     architectures for a particular operating system release.
     """
-    def __init__(self, name, topdir, repos):
-        r = {}
+    def __init__(self, name, topdir, repos, pool=None):
+        """
+        Create the Repository for each of the architectures of each operating
+        system in the *repos* dict, using the optional thread *pool* to load
+        them concurrently.
+        """
+        jobs = []
         for osname in repos:
-            r[osname] = {}
             for arch in repos[osname]:
                 if arch == 'SRPMS' or arch == 'src':
-                    r[osname]['src'] = Repository(topdir, osname, 'SRPMS')
+                    jobs.append((osname, 'src', 'SRPMS'))
                 else:
-                    r[osname][arch] = Repository(topdir, osname, arch)
+                    jobs.append((osname, arch, arch))
+        repositories = repo._parallel_map(
+            lambda job: Repository(topdir, job[0], job[2]), jobs, pool)
+        r = {}
+        for osname in repos:
+            r[osname] = {}
+        for (osname, arch, dirname), repository in zip(jobs, repositories):
+            r[osname][arch] = repository
         super(Release, self).__init__(name, r)
 
     def repositories_for_package(self, package):
@@ -264,7 +505,7 @@ class Manager(repo.Manager):
     def __init__(
             self, root=repo.default_root,
             releases=repo.default_releases, os_names=None,
-            exclude_os_names=None):
+            exclude_os_names=None, workers=None):
         """
         Constructor
         -----------
@@ -283,6 +524,9 @@ class Manager(repo.Manager):
             (Optional) List of operating system name/version (e.g. el/7) to
             skip. If None, then all yum-based OSes will be managed. This is
             evaluated after os_names
+        *workers*::
+            (Optional) Number of threads used to load the repositories of all
+            releases concurrently. If None or 1, they are loaded serially.
         """
         oses = dict()
         oses = Manager.find_operating_systems(root, releases[0])
@@ -298,12 +542,14 @@ class Manager(repo.Manager):
                 if osname not in exclude_os_names:
                     new_oses[osname] = oses[osname]
             oses = new_oses
-        yum_releases = {}
-        for release in releases:
-            yum_releases[release] = Release(
+        yum_releases = repo._load_releases(
+            releases,
+            lambda release, pool: Release(
                     release,
                     os.path.join(root, release, 'rpm'),
-                    oses)
+                    oses,
+                    pool),
+            workers)
         super(Manager, self).__init__(yum_releases)
 
     @staticmethod
@@ -22,16 +22,129 @@ import datetime
 import hashlib
 import os
 import os.path
-import re
+import shutil
+import tempfile
 import repo
 import repo.package
-import shutil
+import repo.rpmheader
 
 """
 List of supported Zypper-based Linux distributions
 """
 default_zypper_distros = ["sles/11"]
 
+"""
+Version of the format of the cached RPM header records. Change this when
+the contents of the records change
+"""
+header_cache_version = 2
+
+_descr_tags = frozenset([
+    repo.rpmheader.RPMTAG_NAME,
+    repo.rpmheader.RPMTAG_VERSION,
+    repo.rpmheader.RPMTAG_RELEASE,
+    repo.rpmheader.RPMTAG_EPOCH,
+    repo.rpmheader.RPMTAG_SUMMARY,
+    repo.rpmheader.RPMTAG_DESCRIPTION,
+    repo.rpmheader.RPMTAG_BUILDTIME,
+    repo.rpmheader.RPMTAG_SIZE,
+    repo.rpmheader.RPMTAG_LICENSE,
+    repo.rpmheader.RPMTAG_GROUP,
+    repo.rpmheader.RPMTAG_ARCH,
+    repo.rpmheader.RPMTAG_SOURCERPM,
+    repo.rpmheader.RPMTAG_PROVIDENAME,
+    repo.rpmheader.RPMTAG_PROVIDEFLAGS,
+    repo.rpmheader.RPMTAG_PROVIDEVERSION,
+    repo.rpmheader.RPMTAG_REQUIRENAME,
+    repo.rpmheader.RPMTAG_REQUIREFLAGS,
+    repo.rpmheader.RPMTAG_REQUIREVERSION,
+    repo.rpmheader.RPMTAG_CONFLICTNAME,
+    repo.rpmheader.RPMTAG_CONFLICTFLAGS,
+    repo.rpmheader.RPMTAG_CONFLICTVERSION,
+    repo.rpmheader.RPMTAG_OBSOLETENAME,
+    repo.rpmheader.RPMTAG_OBSOLETEFLAGS,
+    repo.rpmheader.RPMTAG_OBSOLETEVERSION,
+])
+
+
+def _dependencies(header, name_tag, flags_tag, version_tag):
+    """
+    Return a list of (name, flags, version) tuples for one dependency type
+    in an RPM *header*
+    """
+    names = header.get(name_tag, [])
+    flags = header.get(flags_tag, [0] * len(names))
+    versions = header.get(version_tag, [""] * len(names))
+    return zip(names, flags, versions)
+
+
+def _rpm_record(path):
+    """
+    Read the header of the RPM package at *path* and return a dict of the
+    values written to the packages and packages.en description files
+    """
+    rpmheader = repo.rpmheader
+    header = rpmheader.read_header(path, _descr_tags)
+    sourcerpm = header.get(rpmheader.RPMTAG_SOURCERPM)
+    epoch = header.get(rpmheader.RPMTAG_EPOCH)
+    return {
+        'name': header[rpmheader.RPMTAG_NAME],
+        'version': header[rpmheader.RPMTAG_VERSION],
+        'release': header[rpmheader.RPMTAG_RELEASE],
+        'epoch': epoch[0] if epoch else None,
+        # Source packages have no SOURCERPM tag
+        'arch': header[rpmheader.RPMTAG_ARCH] if sourcerpm else 'src',
+        'summary': header.get(rpmheader.RPMTAG_SUMMARY, ""),
+        'description': header.get(rpmheader.RPMTAG_DESCRIPTION, ""),
+        'buildtime': header.get(rpmheader.RPMTAG_BUILDTIME, [0])[0],
+        'installsize': header.get(rpmheader.RPMTAG_SIZE, [0])[0],
+        'license': header.get(rpmheader.RPMTAG_LICENSE, ""),
+        'group': header.get(rpmheader.RPMTAG_GROUP, ""),
+        'sourcerpm': sourcerpm,
+        'checksum': repo._metadata_digest(path),
+        'provides': _dependencies(
+            header, rpmheader.RPMTAG_PROVIDENAME,
+            rpmheader.RPMTAG_PROVIDEFLAGS, rpmheader.RPMTAG_PROVIDEVERSION),
+        'requires': _dependencies(
+            header, rpmheader.RPMTAG_REQUIRENAME,
+            rpmheader.RPMTAG_REQUIREFLAGS, rpmheader.RPMTAG_REQUIREVERSION),
+        'conflicts': _dependencies(
+            header, rpmheader.RPMTAG_CONFLICTNAME,
+            rpmheader.RPMTAG_CONFLICTFLAGS,
+            rpmheader.RPMTAG_CONFLICTVERSION),
+        'obsoletes': _dependencies(
+            header, rpmheader.RPMTAG_OBSOLETENAME,
+            rpmheader.RPMTAG_OBSOLETEFLAGS,
+            rpmheader.RPMTAG_OBSOLETEVERSION),
+    }
+
+
+def _format_dependency(dependency):
+    (name, flags, version) = dependency
+    if not version:
+        return name
+    op = ""
+    if flags & repo.rpmheader.RPMSENSE_LESS:
+        op += "<"
+    if flags & repo.rpmheader.RPMSENSE_GREATER:
+        op += ">"
+    if flags & repo.rpmheader.RPMSENSE_EQUAL:
+        op += "="
+    return " ".join([name, op, version])
+
+
+def _dependency_block(tag, dependencies):
+    """
+    Return the +*tag*: ... -*tag*: block listing *dependencies*, each of
+    them once
+    """
+    lines = []
+    for d in dependencies:
+        line = _format_dependency(d) + "\n"
+        if line not in lines:
+            lines.append(line)
+    return "+%s:\n%s-%s:\n" % (tag, "".join(lines), tag)
+
 
 class Repository(repo.Repository):
     """
@@ -40,39 +153,10 @@ class Repository(repo.Repository):
     This class contains the zypper package repository metadata for a particular
     operating system version.
     """
-    grp_restring = r"=Grp:[\t ]*(?P<group>.*)\n"
-    lic_restring = r"=Lic:[\t ]*(?P<license>.*)\n"
-    loc_restring = r"=Loc:[\t ]*(\d+)[\t ]+(?P<location>[^ \t\n]*).*\n"
-    pkg_restring = r"=Pkg:[\t ]*(?P<pkgname>[^ \t]*)[\t ]+(?P<pkgversion>[^ \t]*)[ \t]+(?P<pkgrelease>[^ \t]*)[ \t]+(?P<arch>.+)\n"
-    shr_restring = r"=Shr:[\t ].*\n"
-    siz_restring = r"=Siz:[\t ]*(?P<size>\d+).*\n"
-    src_restring = r"=Src:[\t ]*(?P<srcname>\S+)[\t ]+(?P<srcver>\S+)[\t ]+(?P<srcrel>\S+)[\t ]+(?P<srcarch>.+)\n"
-    tim_restring = r"=Tim:[\t ]*(?P<time>\d+)\n"
-    ver_restring = r"=Ver:[\t ]*(?P<repover>[0-9.]+)\n"
-    con_restring = r"\+Con:[\t ]*(?P<conflicts>(\n(?!-Con:).*)*)\n-Con:\n"
-    obs_restring = r"\+Obs:[\t ]*(?P<obsoletes>(\n(?!-Obs:).*)*)\n-Obs:\n"
-    prq_restring = r"\+Prq:[\t ]*(?P<prq>(\n(?!-Prq:).*)*)\n-Prq:\n"
-    prv_restring = r"\+Prv:[\t ]*(?P<prv>(\n(?!-Prv:).*)*)\n-Prv:\n"
-    req_restring = r"\+Req:[\t ]*(?P<requires>(\n(?!-Req:).*)*)\n-Req:\n"
-    dashd_restring = r"##[\t ]+-d.*\n"
-    start_restring = r"##-+\n"
-
-    parse_re = re.compile(
-        ver_restring + "|" + start_restring + "(" + "|".join([
-            grp_restring,
-            lic_restring,
-            loc_restring,
-            pkg_restring,
-            shr_restring,
-            siz_restring,
-            src_restring,
-            tim_restring,
-            con_restring,
-            obs_restring,
-            prq_restring,
-            prv_restring,
-            req_restring,
-            dashd_restring]) + ")+", re.M)
+    """
+    Record separator line between packages in a setup/descr/packages file
+    """
+    record_marker = "##-"
 
     def __init__(self, repo_path, osname):
         super(Repository, self).__init__()
@@ -85,45 +169,78 @@ class Repository(repo.Repository):
         if not os.path.exists(self.packages_path):
             self.update_metadata(force=True)
 
-        f = file(self.packages_path, "r")
-        metadata = f.read()
-
-        datasize = len(metadata)
-        offset = 0
-        while offset < datasize:
-            m = Repository.parse_re.match(metadata[offset:])
-            if m is None:
-                raise Exception("Parsing error", metadata[offset:offset+200])
-            offset += len(m.group(0))
-            if m is not None and m.group('pkgname') is not None:
-                srcref = None
-                if m.group('arch') == 'src':
-                    srcref = "-".join([
-                        m.group('pkgname'),
-                        m.group('pkgversion'),
-                        m.group('pkgrelease')])
+        self._insert_packages(self._cached_packages(
+            self.packages_path, self.__parse_packages))
+
+    def __parse_packages(self, packages_path):
+        """
+        Parse a setup/descr/packages file and return a list of the package
+        metadata in it
+
+        The file is scanned once, line by line. Single-line =Tag: values are
+        collected into a record for each package, multi-line +Tag: ... -Tag:
+        blocks (dependencies, descriptions) are skipped without being stored.
+        """
+        packages = []
+        record = None
+        block_end = None
+        f = file(packages_path, "r")
+        try:
+            for line in f:
+                line = line.rstrip("\n")
+                if block_end is not None:
+                    if line.startswith(block_end):
+                        block_end = None
+                    continue
+                if line.startswith("##"):
+                    if line.startswith(Repository.record_marker):
+                        self.__add_record(record, packages)
+                        record = {}
+                    continue
+                tag = line[:5]
+                if len(tag) != 5 or tag[4] != ':':
+                    if line.strip() == "":
+                        continue
+                    raise Exception("Parsing error", line)
+                if tag[0] == '+':
+                    block_end = "-" + tag[1:]
+                elif tag[0] == '=':
+                    if record is not None:
+                        record[tag[1:4]] = line[5:].strip()
                 else:
-                    srcref = "-".join([
-                                m.group('srcname'),
-                                m.group('srcver'),
-                                m.group('srcrel')])
-                pkg = repo.package.Metadata(
-                        m.group('pkgname'),
-                        m.group('pkgversion'),
-                        m.group('pkgrelease'),
-                        os.path.join(
-                            self.repo_path,
-                            "RPMS",
-                            m.group('arch'),
-                            m.group('location')),
-                        m.group('arch'),
-                        srcref,
-                        self.os)
-                if pkg.name not in self.packages:
-                    self.packages[pkg.name] = []
-                self.packages[pkg.name].append(pkg)
-        for p in self.packages:
-            self.packages[p].sort()
+                    raise Exception("Parsing error", line)
+        finally:
+            f.close()
+        if block_end is not None:
+            raise Exception("Parsing error", "missing " + block_end)
+        self.__add_record(record, packages)
+        return packages
+
+    def __add_record(self, record, packages):
+        """
+        Append the package metadata for a parsed packages file record
+        to the list *packages*. Records without a =Pkg: tag are ignored.
+        """
+        if not record or 'Pkg' not in record:
+            return
+        try:
+            (pkgname, pkgversion, pkgrelease, arch) = \
+                record['Pkg'].split(None, 3)
+            location = record['Loc'].split()[1]
+            if arch == 'src':
+                srcref = "-".join([pkgname, pkgversion, pkgrelease])
+            else:
+                srcref = "-".join(record['Src'].split(None, 3)[:3])
+        except (KeyError, IndexError, ValueError):
+            raise Exception("Parsing error", record['Pkg'])
+        packages.append(repo.package.Metadata(
+                pkgname,
+                pkgversion,
+                pkgrelease,
+                os.path.join(self.repo_path, "RPMS", arch, location),
+                arch,
+                srcref,
+                self.os))
 
     def add_package(self, package, update_metadata=False):
         dest_rpm_path = os.path.join(
@@ -132,9 +249,7 @@ class Repository(repo.Repository):
             package.arch,
             os.path.basename(package.path))
         if not os.path.exists(dest_rpm_path):
-            shutil.copy(package.path, dest_rpm_path)
-        if package.name not in self.packages:
-            self.packages[package.name] = []
+            repo._copy_file(package.path, dest_rpm_path)
 
         # Create a new repo.package.Metadata with the new path
         new_package = repo.package.Metadata(
@@ -145,27 +260,156 @@ class Repository(repo.Repository):
                 package.source_name,
                 self.os)
 
-        self.packages[package.name].append(new_package)
-        self.packages[package.name].sort()
+        self._insert_package(new_package)
         if update_metadata:
             self.update_metadata()
         else:
             self.dirty = True
         return new_package
 
+    def __rpm_records(self):
+        """
+        Return a sorted list of (arch directory, file name, record) tuples
+        for the RPM packages in the repository. Records for files whose stat
+        information is unchanged since the last run are loaded from the
+        header cache, so only new or replaced packages are read.
+        """
+        cache_path = repo._cache_path("zypper", hashlib.sha1(
+            os.path.abspath(self.repo_path)).hexdigest() + ".pickle")
+        cached = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            try:
+                f = open(cache_path, "rb")
+                try:
+                    entry = repo.pickle.load(f)
+                finally:
+                    f.close()
+                if entry['version'] == header_cache_version and \
+                        entry['path'] == self.repo_path:
+                    cached = entry['records']
+            except Exception:
+                cached = {}
+
+        rpms_dir = os.path.join(self.repo_path, "RPMS")
+        records = {}
+        changed = False
+        for archdir in sorted(os.listdir(rpms_dir)):
+            archpath = os.path.join(rpms_dir, archdir)
+            if not os.path.isdir(archpath):
+                continue
+            for entry in sorted(os.listdir(archpath)):
+                if not entry.endswith(".rpm"):
+                    continue
+                relpath = os.path.join(archdir, entry)
+                path = os.path.join(archpath, entry)
+                signature = repo._metadata_signature(path)
+                if relpath in cached and cached[relpath][0] == signature:
+                    records[relpath] = cached[relpath]
+                else:
+                    records[relpath] = (signature, _rpm_record(path))
+                    changed = True
+        if cache_path is not None and (changed or len(records) != len(cached)):
+            try:
+                repo._write_atomic(cache_path, repo.pickle.dumps({
+                    'version': header_cache_version,
+                    'path': self.repo_path,
+                    'records': records,
+                }, 2))
+            except (IOError, OSError):
+                pass
+        return [
+            (os.path.dirname(relpath), os.path.basename(relpath),
+                records[relpath][1])
+            for relpath in sorted(records)]
+
+    def __write_descr(self, descr_dir):
+        """
+        Write the packages and packages.en description files for the RPM
+        packages in the repository to *descr_dir*, in the format written by
+        create_package_descr. The packages.DU disk usage file is not
+        generated: it needs the file lists of the packages, and zypper only
+        uses it for the optional disk space check before installing. A
+        packages.DU left by an earlier create_package_descr run is removed,
+        as it would no longer match the packages.
+        Returns a dict mapping the name of each file to its SHA1 hash.
+        """
+        packages = ["=Ver: 2.0\n"]
+        packages_en = ["=Ver: 2.0\n"]
+        for (archdir, filename, record) in self.__rpm_records():
+            pkg = "=Pkg: %s %s %s %s\n" % (
+                record['name'], record['version'], record['release'],
+                record['arch'])
+            prereqs = [
+                d for d in record['requires']
+                if d[1] & (repo.rpmheader.RPMSENSE_PREREQ |
+                           repo.rpmheader.RPMSENSE_SCRIPT_PRE |
+                           repo.rpmheader.RPMSENSE_SCRIPT_POST)
+                and not d[1] & repo.rpmheader.RPMSENSE_RPMLIB
+                and not d[0].startswith("rpmlib(")]
+            requires = [
+                d for d in record['requires']
+                if not d[1] & repo.rpmheader.RPMSENSE_RPMLIB
+                and not d[0].startswith("rpmlib(")
+                and d not in prereqs]
+            packages.append("##----------------------------------------\n")
+            packages.append(pkg)
+            packages.append("=Cks: SHA1 %s\n" % record['checksum'])
+            packages.append(_dependency_block("Req", requires))
+            packages.append(_dependency_block("Prq", prereqs))
+            packages.append(_dependency_block("Prv", record['provides']))
+            packages.append(_dependency_block("Con", record['conflicts']))
+            packages.append(_dependency_block("Obs", record['obsoletes']))
+            packages.append("=Grp: %s\n" % record['group'])
+            packages.append("=Lic: %s\n" % record['license'])
+            if record['sourcerpm'] is not None:
+                # name-version-release.arch.rpm
+                (srcnvr, srcarch) = \
+                    record['sourcerpm'][:-len(".rpm")].rsplit(".", 1)
+                packages.append("=Src: %s %s\n" % (
+                    " ".join(srcnvr.rsplit("-", 2)), srcarch))
+            packages.append("=Tim: %d\n" % record['buildtime'])
+            if archdir == record['arch']:
+                packages.append("=Loc: 1 %s\n" % filename)
+            else:
+                packages.append("=Loc: 1 %s %s\n" % (filename, archdir))
+            packages.append("=Siz: %d %d\n" % (
+                os.path.getsize(
+                    os.path.join(self.repo_path, "RPMS", archdir, filename)),
+                record['installsize']))
+
+            packages_en.append("##----------------------------------------\n")
+            packages_en.append(pkg)
+            packages_en.append("=Sum: %s\n" % record['summary'])
+            packages_en.append("+Des:\n%s\n-Des:\n" % (
+                record['description'].rstrip("\n")))
+
+        hashes = {}
+        for (name, data) in [
+                ("packages", "".join(packages)),
+                ("packages.en", "".join(packages_en))]:
+            repo._write_atomic(os.path.join(descr_dir, name), data, 0o664)
+            hashes[name] = hashlib.sha1(data).hexdigest()
+        du_path = os.path.join(descr_dir, "packages.DU")
+        if os.path.lexists(du_path):
+            os.remove(du_path)
+        return hashes
+
     def update_metadata(self, force=False):
         """
         Update the zypper repository metadata for the packages in the specified
-        repository.
+        repository. Returns a list of messages describing the failed
+        commands.
         """
         if not(force or self.dirty):
-            return
+            return []
 
         self.dirty = False
         distro_repodir = self.repo_path
 
         print("Updating metadata in ", distro_repodir)
-        dirs = ["media.1", "RPMS/noarch", "RPMS/src", "RPMS/x86_64"]
+        dirs = [
+            "media.1", "RPMS/noarch", "RPMS/src", "RPMS/x86_64",
+            "setup/descr"]
         for dirname in [(os.path.join(distro_repodir, x)) for x in dirs]:
             if not os.path.exists(dirname):
                 os.makedirs(dirname, 0o775)
@@ -178,20 +422,15 @@ class Repository(repo.Repository):
         media_path = os.path.join(distro_repodir, "media.1", "media")
 
         if not os.path.exists(media_path):
-            media_file = file(media_path, "w")
-            media_file.write(
+            repo._write_atomic(
+                media_path,
                 "Globus Support\n%s\n1\n" %
-                (datetime.datetime.now().strftime("%Y%m%d%H%M%S")))
-            media_file.close()
+                (datetime.datetime.now().strftime("%Y%m%d%H%M%S")), 0o664)
         content_key_path = os.path.join(distro_repodir, "content.key")
         if not os.path.exists(content_key_path):
-            content_key_file = file(content_key_path, "w")
-            content_key_file.write(repo.public_key)
-            content_key_file.close()
+            repo._write_atomic(content_key_path, repo.public_key, 0o664)
 
-        content_path = os.path.join(distro_repodir, "content")
-        content_file = file(content_path, "w")
-        content_file.write("""PRODUCT Globus Toolkit
+        content = ["""PRODUCT Globus Toolkit
 VERSION 6
 LABEL Globus Toolkit (SUSE LINUX)
 VENDOR Globus Support
@@ -199,38 +438,102 @@ ARCH.x86_64 x86_64 noarch
 DEFAULTBASE x86_64
 DESCRDIR setup/descr
 DATADIR RPMS
-""")
+"""]
         directory_yast_path = os.path.join(distro_repodir, "directory.yast")
-        directory_yast_file = file(directory_yast_path, "w")
-        for entry in os.listdir(distro_repodir):
-            directory_yast_file.write(entry + "\n")
-        directory_yast_file.close()
-
-        os.system('cd "%s"; create_package_descr -d "RPMS"' % (distro_repodir))
+        entries = [
+            entry for entry in os.listdir(distro_repodir)
+            if not entry.startswith(".")]
+        if "directory.yast" not in entries:
+            entries.append("directory.yast")
+        repo._write_atomic(
+            directory_yast_path,
+            "".join(entry + "\n" for entry in entries), 0o664)
 
         descr_dir = os.path.join(distro_repodir, "setup", "descr")
+        descr_hashes = self.__write_descr(descr_dir)
 
-        for entry in os.listdir(descr_dir):
-            entry_file = file(os.path.join(descr_dir, entry), "r")
-            entry_sha1 = hashlib.sha1()
-            entry_sha1.update(entry_file.read())
-            content_file.write("META SHA1 %s  %s\n" % (
-                entry_sha1.hexdigest(), entry))
+        for entry in sorted(os.listdir(descr_dir)):
+            if entry in descr_hashes:
+                entry_sha1 = descr_hashes[entry]
+            elif entry.startswith("."):
+                continue
+            else:
+                entry_sha1 = repo._metadata_digest(
+                    os.path.join(descr_dir, entry))
+            content.append("META SHA1 %s  %s\n" % (entry_sha1, entry))
 
         key_sha1 = hashlib.sha1()
         key_sha1.update(repo.public_key)
-        content_file.write("KEY SHA1 %s  %s\n" % (
+        content.append("KEY SHA1 %s  %s\n" % (
                 key_sha1.hexdigest(), "content.key"))
-        content_file.close()
-
-        content_asc = os.path.join(distro_repodir, "content.asc")
-        if os.path.exists(content_asc):
-            os.remove(content_asc)
-        if os.getenv("GPG_AGENT_INFO") is not None:
-            os.system("cd \"%s\"; gpg --batch --use-agent -ab content" %
-                      (distro_repodir))
-        else:
-            os.system("cd \"%s\"; gpg -ab content" % (distro_repodir))
+        return self.__publish_content("".join(content))
+
+    def __publish_content(self, data):
+        """
+        Publish the content file with *data* and its detached signature
+        content.asc. Both are written to a new .content-* staging directory
+        and signed there. The .content symbolic link is then switched to
+        that directory with a single rename, and content and content.asc
+        are links into .content, so readers always see a matching pair. If
+        signing fails, the published files are left alone. Returns a list
+        of messages describing the failed commands.
+        """
+        failures = []
+        stage = tempfile.mkdtemp(dir=self.repo_path, prefix=".content-")
+        try:
+            os.chmod(stage, 0o775)
+            if repo.gid is not None:
+                os.chown(stage, repo.uid, repo.gid)
+                os.chmod(stage, 0o2775)
+            stage_content = os.path.join(stage, "content")
+            repo._write_atomic(stage_content, data, 0o664)
+            if os.getenv("GPG_AGENT_INFO") is not None:
+                gpg = ["gpg", "--batch", "--use-agent"]
+            else:
+                # setup_gpg_agent only sets GPG_AGENT_INFO for child
+                # processes, so let gpg ask for the passphrase if needed
+                gpg = ["gpg"]
+            if not repo._run_command(
+                    gpg + ["--output", stage_content + ".asc", "-ab",
+                           stage_content],
+                    failures):
+                return failures
+            os.chmod(stage_content + ".asc", 0o664)
+
+            current = os.path.join(self.repo_path, ".content")
+            try:
+                previous = os.readlink(current)
+            except OSError:
+                previous = None
+            Repository.__replace_with_symlink(
+                os.path.basename(stage), current)
+            stage = None
+            for name in ["content", "content.asc"]:
+                path = os.path.join(self.repo_path, name)
+                target = os.path.join(".content", name)
+                if not os.path.islink(path) or \
+                        os.readlink(path) != target:
+                    Repository.__replace_with_symlink(target, path)
+            if previous is not None and previous.startswith(".content-"):
+                shutil.rmtree(os.path.join(self.repo_path, previous), True)
+        finally:
+            if stage is not None:
+                shutil.rmtree(stage, True)
+        return failures
+
+    @staticmethod
+    def __replace_with_symlink(target, path):
+        """
+        Atomically replace *path* with a symbolic link to *target*
+        """
+        dirname, basename = os.path.split(path)
+        tmp_path = repo._link_temporary(
+            target, dirname, "." + basename + ".", os.symlink)
+        try:
+            os.rename(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
 
 
 class Release(repo.Release):
@@ -240,10 +543,14 @@ class Release(repo.Release):
     Each Release contains a collection of repositories for different
     architectures for a particular operating system release.
     """
-    def __init__(self, name, topdir, repos):
-        r = {}
-        for osname in repos:
-            r[osname] = Repository(topdir, osname)
+    def __init__(self, name, topdir, repos, pool=None):
+        """
+        Create the Repository for each operating system in the *repos*
+        list, using the optional thread *pool* to load them concurrently.
+        """
+        repositories = repo._parallel_map(
+            lambda osname: Repository(topdir, osname), repos, pool)
+        r = dict(zip(repos, repositories))
         super(Release, self).__init__(name, r)
 
     def repositories_for_os_arch(self, osname, arch):
@@ -272,7 +579,7 @@ class Manager(repo.Manager):
     """
     def __init__(self, root=repo.default_root,
                  releases=repo.default_releases, os_names=None,
-                 exclude_os_names=None):
+                 exclude_os_names=None, workers=None):
         """
         Constructor
         -----------
@@ -291,6 +598,9 @@ class Manager(repo.Manager):
             (Optional) List of operating system name/version (e.g. sles/11) to
             skip. If None, then all zypper-based OSes will be managed. This is
             evaluated after os_names
+        *workers*::
+            (Optional) Number of threads used to load the repositories of all
+            releases concurrently. If None or 1, they are loaded serially.
         """
         oses = Manager.find_operating_systems(root, releases[0])
 
@@ -301,12 +611,14 @@ class Manager(repo.Manager):
                 osname for osname in oses
                 if osname not in exclude_os_names
             ]
-        zypper_releases = {}
-        for release in releases:
-            zypper_releases[release] = Release(
+        zypper_releases = repo._load_releases(
+            releases,
+            lambda release, pool: Release(
                     release,
                     os.path.join(root, release, 'rpm'),
-                    oses)
+                    oses,
+                    pool),
+            workers)
         super(Manager, self).__init__(zypper_releases)
 
     @staticmethod
@@ -0,0 +1,206 @@
+#! /usr/bin/python
+
+# Copyright 2014-2015 University of Chicago
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measure the memory used by the parsed package metadata of a release tree.
+A synthetic tree of yum and deb repositories is generated (or an existing
+tree is used with --root), loaded through repo.yum.Manager and
+repo.deb.Manager, and the growth of the resident set size of the process is
+reported. Run it with --library pointing at the share/python directory of
+another checkout to compare two versions of the repo package.
+"""
+
+from __future__ import print_function
+
+import argparse
+import bz2
+import gc
+import gzip
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+yum_repos = {
+    "el/6": ["i386", "SRPMS", "x86_64"],
+    "el/7": ["SRPMS", "x86_64"],
+    "fedora/24": ["i386", "SRPMS", "x86_64"],
+}
+deb_codenames = ["trusty", "xenial", "jessie"]
+releases = ["unstable", "testing", "stable"]
+
+
+def rss():
+    """
+    Return the resident set size of this process in bytes
+    """
+    f = open("/proc/self/statm")
+    try:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    finally:
+        f.close()
+
+
+def package_names(count):
+    for i in range(count):
+        source = "globus-pkg%d" % (i // 4)
+        suffix = ["", "-devel", "-doc", "-progs"][i % 4]
+        yield (source, source + suffix, "%d.%d" % (i // 40, i % 17))
+
+
+def make_yum_repo(path, osname, arch, count):
+    """
+    Write the repomd.xml and primary_db of a yum repository with *count*
+    packages, as createrepo -d would
+    """
+    repodata = os.path.join(path, "repodata")
+    os.makedirs(repodata)
+    rel = "1.gt6." + osname.replace("/", "")
+    if arch == "SRPMS":
+        arch = "src"
+    dbpath = os.path.join(repodata, "primary.sqlite")
+    conn = sqlite3.connect(dbpath)
+    conn.execute(
+        "CREATE TABLE packages (name TEXT, version TEXT, release TEXT, "
+        "location_href TEXT, arch TEXT, rpm_sourcerpm TEXT)")
+    rows = []
+    for source, name, version in package_names(count):
+        if arch == "src":
+            name = source
+        rows.append((
+            name, version, rel,
+            "%s-%s-%s.%s.rpm" % (name, version, rel, arch), arch,
+            "%s-%s-%s.src.rpm" % (source, version, rel)))
+    conn.executemany("INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+    f = open(dbpath, "rb")
+    data = f.read()
+    f.close()
+    os.remove(dbpath)
+    f = open(dbpath + ".bz2", "wb")
+    f.write(bz2.compress(data))
+    f.close()
+
+    f = open(os.path.join(repodata, "repomd.xml"), "w")
+    f.write(
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<repomd xmlns="http://linux.duke.edu/metadata/repo">\n'
+        '<data type="primary_db">'
+        '<location href="repodata/primary.sqlite.bz2"/></data>\n'
+        '</repomd>\n')
+    f.close()
+
+
+def make_deb_repo(base, codename, count):
+    contrib = os.path.join(base, "dists", codename, "contrib")
+    sources = []
+    binaries = {"amd64": [], "i386": []}
+    rel = "1+gt6." + codename
+    for source, name, version in package_names(count):
+        sources.append(
+            "Package: %s\nBinary: %s\nVersion: %s-%s\n"
+            "Architecture: any\nFiles:\n abc 10 %s_%s.dsc\n\n" % (
+                source, name, version, rel, source, version))
+        pooldir = os.path.join(base, "pool", "contrib", source[0], source)
+        if not os.path.exists(pooldir):
+            os.makedirs(pooldir)
+        for suffix in ["source", "source+all+amd64", "source+all+i386"]:
+            open(os.path.join(pooldir, "%s_%s-%s_%s.changes" % (
+                source, version, rel, suffix)), "w").close()
+        for arch in binaries:
+            binaries[arch].append(
+                "Package: %s\nSource: %s\nVersion: %s-%s\n"
+                "Architecture: %s\n"
+                "Filename: pool/contrib/%s/%s/%s_%s-%s_%s.deb\n\n" % (
+                    name, source, version, rel, arch, source[0], source,
+                    name, version, rel, arch))
+    os.makedirs(os.path.join(contrib, "source"))
+    f = gzip.open(os.path.join(contrib, "source", "Sources.gz"), "wb")
+    f.write("".join(sources))
+    f.close()
+    for arch in binaries:
+        os.makedirs(os.path.join(contrib, "binary-" + arch))
+        f = gzip.open(
+            os.path.join(contrib, "binary-" + arch, "Packages.gz"), "wb")
+        f.write("".join(binaries[arch]))
+        f.close()
+
+
+def make_tree(root, count):
+    for release in releases:
+        for osname in yum_repos:
+            for arch in yum_repos[osname]:
+                make_yum_repo(
+                    os.path.join(root, release, "rpm", osname, arch),
+                    osname, arch, count)
+        for codename in deb_codenames:
+            make_deb_repo(
+                os.path.join(root, release, "deb"), codename, count)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report the memory used by parsed package metadata")
+    parser.add_argument(
+        "-n", "--packages", type=int, default=20000,
+        help="Number of packages in each generated repository [20000]")
+    parser.add_argument(
+        "--root", default=None,
+        help="Load the existing release tree ROOT instead of generating one")
+    parser.add_argument(
+        "--library", default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            "..", "share", "python"),
+        help="Directory containing the repo package to measure")
+    args = parser.parse_args()
+
+    sys.path.insert(0, args.library)
+    import repo
+    import repo.deb
+    import repo.yum
+    repo.cache_dir = None
+
+    root = args.root
+    if root is None:
+        root = tempfile.mkdtemp()
+        make_tree(root, args.packages)
+    try:
+        gc.collect()
+        before = rss()
+        managers = [
+            repo.yum.Manager(root=root, releases=releases),
+            repo.deb.Manager(root=root, releases=releases),
+        ]
+        gc.collect()
+        after = rss()
+        packages = sum(
+            len(release.get_packages())
+            for manager in managers
+            for release in manager.releases.values())
+    finally:
+        if args.root is None:
+            shutil.rmtree(root)
+
+    print("library: %s" % (os.path.abspath(args.library)))
+    print("packages: %d" % (packages))
+    print("rss growth: %.1f MiB" % ((after - before) / 1048576.0))
+    print("bytes per package: %d" % ((after - before) // max(packages, 1)))
+
+if __name__ == "__main__":
+    main()
+# vim: filetype=python:
@@ -0,0 +1,118 @@
+# Copyright 2014-2015 University of Chicago
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test of the stanza splitting used by repo.deb.Repository to parse Packages
+and Sources files, including files with CRLF line endings and stanzas
+separated by lines containing only whitespace.
+"""
+
+import gzip
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "share",
+        "python"))
+
+import repo
+import repo.deb
+
+packages = [
+    ("globus-common", "16.0-1", "any"),
+    ("globus-gssapi-gsi", "12.1-1", "any"),
+    ("globus-common-doc", "16.0-1", "all"),
+]
+
+
+def sources_file(separator, newline="\n"):
+    """
+    Return the contents of a Sources file describing *packages*, with the
+    stanzas separated by *separator* and lines ending with *newline*
+    """
+    stanzas = []
+    for (name, version, arch) in packages:
+        stanzas.append(newline.join([
+            "Package: %s" % name,
+            "Binary: %s" % name,
+            "Version: %s" % version,
+            "Architecture: %s" % arch,
+            "Description: %s" % name,
+            " .",
+            " Continuation line",
+        ]) + newline)
+    return separator.join(stanzas)
+
+
+class DebStanzasTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = repo.cache_dir
+        repo.cache_dir = None
+        self.top = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.top, "pool", "contrib"))
+        self.source_dir = os.path.join(
+            self.top, "dists", "trusty", "contrib", "source")
+        os.makedirs(self.source_dir)
+
+    def tearDown(self):
+        repo.cache_dir = self.cache_dir
+        shutil.rmtree(self.top)
+
+    def names(self, contents, blocksize=1 << 20):
+        return [
+            dict(repo.deb.stanza_field_re.findall(stanza))[
+                'Package'].rstrip()
+            for stanza in repo.deb._stanzas(
+                StringIO.StringIO(contents), blocksize)]
+
+    def test_separators(self):
+        expected = [name for (name, version, arch) in packages]
+        for separator in ["\n", " \n", "\t\n", "\n\n", "\r\n"]:
+            self.assertEqual(
+                self.names(sources_file(separator)), expected,
+                repr(separator))
+
+    def test_crlf_block_boundaries(self):
+        expected = [name for (name, version, arch) in packages]
+        contents = sources_file("\r\n", "\r\n")
+        for blocksize in range(1, len(contents) + 1):
+            self.assertEqual(
+                self.names(contents, blocksize), expected, blocksize)
+
+    def test_crlf_sources_file(self):
+        f = gzip.open(os.path.join(self.source_dir, "Sources.gz"), "wb")
+        try:
+            f.write(sources_file("\r\n", "\r\n"))
+        finally:
+            f.close()
+        repository = repo.deb.Repository(self.top, "trusty", "source")
+        self.assertEqual(
+            sorted(repository.packages.keys()),
+            sorted(name for (name, version, arch) in packages))
+        doc = repository.get_packages(name="globus-common-doc")
+        self.assertEqual(
+            sorted(p.arch for p in doc), ["all", "src"])
+        for p in doc:
+            self.assertEqual(p.version.strversion, "16.0")
+            self.assertEqual(p.version.release, "1")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+# Copyright 2014-2015 University of Chicago
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Differential test of the 'tuple' version comparison backend against the
+original 'float' encoding. Every pair of versions and every pair of
+releases in the corpus must order the same way with both backends, except
+where the float encoding is known to lose information.
+
+The corpus is the list of version strings below. If the
+GLOBUS_RELEASE_TOOLS_TEST_ROOT environment variable names a release tree,
+every version and release string found in it by the deb, yum, zypper,
+packages, and installers parsers is added to the corpus.
+"""
+
+import itertools
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "share",
+        "python"))
+
+import repo
+import repo.package
+import repo.versioncompare as vc
+
+version_components = getattr(vc, "__version_components")
+
+"""
+Version strings of the forms used in the release trees
+"""
+versions = [
+    "0", "0.1", "0.43", "1", "1.0", "1.0.0", "1.2", "1.2.1", "1.2.3.4",
+    "1.10", "1.2a5", "1.2b1", "2.3.4b1pre", "3.0rc2", "3.0rc10", "3.0",
+    "6.0", "6.0.1", "6.0.1409668473", "7.2", "7.2.2", "7.2.2.1",
+    "7.2.2rc1", "7.2p2", "7.2p2-20150212", "7.2p2-20150212a",
+    "7.2p2-20160101", "7.1p2-20160101", "6.6p1-20150706",
+    "1.0_BETA", "1.0.beta3", "1.0beta2", "2.1BETA", "5.2.5", "9.11",
+    "10.2", "11.1", "12.13", "99.99.99.99", "100", "100.1", "2015.01",
+    "1.2.100", "0.1pre", "latest",
+]
+
+"""
+Release strings of the forms used in the release trees
+"""
+releases = [
+    "*", "1", "2", "10", "1+gt6.trusty", "1+gt6.xenial", "2+gt6.trusty",
+    "1.el7", "1.el7.centos", "3.fc23", "1.sles11", "1409668473",
+    "1.1409668473", "0.1.rc1", "", "gt6",
+]
+
+
+def tree_corpus(root):
+    """
+    Return the sets of version and release strings of the packages in the
+    release tree at *root*
+    """
+    import repo.deb
+    import repo.installers
+    import repo.packages
+    import repo.yum
+    import repo.zypper
+
+    found_versions = set()
+    found_releases = set()
+    releases = [
+        release for release in repo.default_releases
+        if os.path.isdir(os.path.join(root, release))]
+    managers = []
+    if releases:
+        if os.path.isdir(os.path.join(root, releases[0], "deb")):
+            managers.append(repo.deb.Manager(root=root, releases=releases))
+        if os.path.isdir(os.path.join(root, releases[0], "rpm")):
+            managers.append(repo.yum.Manager(root=root, releases=releases))
+            managers.append(
+                repo.zypper.Manager(root=root, releases=releases))
+        if os.path.isdir(os.path.join(root, releases[0], "installers")):
+            managers.append(
+                repo.installers.Manager(root=root, releases=releases))
+    if os.path.isdir(os.path.join(root, "packages")):
+        managers.append(repo.packages.Manager(root=root))
+    for manager in managers:
+        for release in manager.releases.values():
+            for package in release.get_packages():
+                found_versions.add(package.version.strversion)
+                found_releases.add(package.version.release)
+    return (found_versions, found_releases)
+
+
+def float_exact(v):
+    """
+    Check whether version2float encodes the version string *v* without
+    overlapping its components
+    """
+    if v == 'latest':
+        return True
+    gsissh, components = version_components(v)
+    for i, c in enumerate(components):
+        if c != int(c) or c < 0:
+            return False
+        if gsissh and i == 3:
+            # The date stamp is scaled to fit below the patch level
+            if c >= 10 ** 8:
+                return False
+        elif i > 0 and c >= 100:
+            return False
+    return True
+
+
+def comparable(v1, v2):
+    """
+    Check whether the float encoding orders *v1* and *v2* exactly. An
+    OpenSSH-portable version's date overlaps the fourth component of a
+    Mozilla-style version with the same major, minor, and patch levels.
+    """
+    if not (float_exact(v1) and float_exact(v2)):
+        return False
+    if 'latest' in (v1, v2):
+        return True
+    g1, c1 = version_components(v1)
+    g2, c2 = version_components(v2)
+    if g1 == g2 or c1[:3] != c2[:3]:
+        return True
+    if g1:
+        c1, c2 = c2, c1
+    # c1 is the Mozilla-style version, c2 the OpenSSH-portable one
+    return c1[3] == 0 and c2[3] >= 10 ** 6
+
+
+def sign(n):
+    return (n > 0) - (n < 0)
+
+
+class VersionCompareTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.versions = set(versions)
+        cls.releases = set(releases)
+        root = os.getenv("GLOBUS_RELEASE_TOOLS_TEST_ROOT")
+        if root is not None:
+            repo.cache_dir = None
+            found_versions, found_releases = tree_corpus(root)
+            cls.versions.update(found_versions)
+            cls.releases.update(found_releases)
+
+    def assert_same_order(self, key, values, exact):
+        mismatches = []
+        for v1, v2 in itertools.combinations(sorted(values), 2):
+            if not exact(v1, v2):
+                continue
+            float_order = sign(cmp(key(v1, 'float'), key(v2, 'float')))
+            tuple_order = sign(cmp(key(v1, 'tuple'), key(v2, 'tuple')))
+            if float_order != tuple_order:
+                mismatches.append((v1, v2, float_order, tuple_order))
+        self.assertEqual(mismatches, [])
+
+    def test_version_order(self):
+        self.assert_same_order(vc.version_key, self.versions, comparable)
+
+    def test_release_order(self):
+        def release_comparable(r1, r2):
+            v1 = vc.release_re.match(r1).group(1).rstrip(".")
+            v2 = vc.release_re.match(r2).group(1).rstrip(".")
+            return (v1 == "" or v2 == "" or comparable(v1, v2))
+        self.assert_same_order(
+            vc.release_key, self.releases, release_comparable)
+
+    def test_large_components(self):
+        self.assertTrue(
+            vc.version_key("1.2.100", 'tuple') >
+            vc.version_key("1.2.99", 'tuple'))
+        self.assertTrue(
+            vc.version_key("1.2.100", 'tuple') <
+            vc.version_key("1.3", 'tuple'))
+        self.assertTrue(
+            vc.version_key("7.2p2-20150213", 'tuple') >
+            vc.version_key("7.2p2-20150212b", 'tuple'))
+
+    def test_mixed_backends(self):
+        v1 = repo.package.Version("1.0", "1", 'float')
+        v2 = repo.package.Version("1.0", "1", 'tuple')
+        self.assertRaises(TypeError, lambda: v1 < v2)
+        self.assertRaises(TypeError, lambda: v1 == v2)
+
+if __name__ == '__main__':
+    unittest.main()
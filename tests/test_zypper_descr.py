@@ -0,0 +1,283 @@
+# Copyright 2014-2015 University of Chicago
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Golden file test of the setup/descr/packages and packages.en files written
+by repo.zypper.Repository. RPM package files are written with the layout
+produced by rpmbuild (lead, signature header, main header and compressed
+cpio payload), and the description files generated for them are compared
+with the files in data/zypper, which hold the output of
+create_package_descr for the same packages.
+"""
+
+import gzip
+import hashlib
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "share",
+        "python"))
+
+import repo
+import repo.rpmheader as rh
+import repo.zypper
+
+data_dir = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "zypper")
+
+RPMTAG_HEADERI18NTABLE = 100
+RPMTAG_PAYLOADFORMAT = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+RPMSIGTAG_SIZE = 1000
+RPMSIGTAG_MD5 = 1004
+
+_alignment = {
+    rh.RPM_INT16_TYPE: 2,
+    rh.RPM_INT32_TYPE: 4,
+    rh.RPM_INT64_TYPE: 8,
+}
+_pack_formats = {
+    rh.RPM_INT8_TYPE: "B",
+    rh.RPM_INT16_TYPE: "H",
+    rh.RPM_INT32_TYPE: "I",
+    rh.RPM_INT64_TYPE: "Q",
+}
+
+
+def header(entries):
+    """
+    Return an RPM header structure holding the (tag, type, value) tuples
+    in *entries*
+    """
+    index = []
+    store = b""
+    for (tag, tagtype, value) in sorted(entries):
+        store += b"\0" * (-len(store) % _alignment.get(tagtype, 1))
+        offset = len(store)
+        if tagtype in _pack_formats:
+            count = len(value)
+            store += struct.pack(
+                ">%d%s" % (count, _pack_formats[tagtype]), *value)
+        elif tagtype == rh.RPM_BIN_TYPE:
+            count = len(value)
+            store += value
+        elif tagtype in (rh.RPM_STRING_ARRAY_TYPE, rh.RPM_I18NSTRING_TYPE):
+            count = len(value)
+            store += b"".join(v + b"\0" for v in value)
+        else:
+            count = 1
+            store += value + b"\0"
+        index.append(struct.pack(">iiii", tag, tagtype, offset, count))
+    return (rh.HEADER_MAGIC + b"\0" * 4 +
+            struct.pack(">II", len(index), len(store)) +
+            b"".join(index) + store)
+
+
+def write_rpm(path, name, version, release, arch, extra=(), source=True):
+    """
+    Write an RPM package file for *name*-*version*-*release*.*arch* with an
+    empty payload and the header tags in *extra* to *path*
+    """
+    trailer = b"070701" + b"0" * 88 + b"0000000B" + b"0" * 8 + b"TRAILER!!!\0"
+    payload = gzip.zlib.compress(trailer + b"\0" * (-len(trailer) % 4))
+    entries = [
+        (RPMTAG_HEADERI18NTABLE, rh.RPM_STRING_ARRAY_TYPE, [b"C"]),
+        (rh.RPMTAG_NAME, rh.RPM_STRING_TYPE, name),
+        (rh.RPMTAG_VERSION, rh.RPM_STRING_TYPE, version),
+        (rh.RPMTAG_RELEASE, rh.RPM_STRING_TYPE, release),
+        (rh.RPMTAG_ARCH, rh.RPM_STRING_TYPE, arch),
+        (RPMTAG_PAYLOADFORMAT, rh.RPM_STRING_TYPE, b"cpio"),
+        (RPMTAG_PAYLOADCOMPRESSOR, rh.RPM_STRING_TYPE, b"gzip"),
+    ] + list(extra)
+    if source:
+        entries.append((
+            rh.RPMTAG_SOURCERPM, rh.RPM_STRING_TYPE,
+            b"-".join([name, version, release]) + b".src.rpm"))
+    main = header(entries)
+    signature = header([
+        (RPMSIGTAG_SIZE, rh.RPM_INT32_TYPE, [len(main) + len(payload)]),
+        (RPMSIGTAG_MD5, rh.RPM_BIN_TYPE,
+            hashlib.md5(main + payload).digest()),
+    ])
+    lead = rh.LEAD_MAGIC + b"\x03\x00" + struct.pack(">hh", 0, 1) + \
+        (name + b"-" + version + b"-" + release).ljust(66, b"\0")[:66] + \
+        struct.pack(">hh", 1, 5) + b"\0" * 16
+    f = open(path, "wb")
+    try:
+        f.write(lead + signature + b"\0" * (-len(signature) % 8) +
+                main + payload)
+    finally:
+        f.close()
+
+
+def common_tags(summary, description, size):
+    return [
+        (rh.RPMTAG_SUMMARY, rh.RPM_I18NSTRING_TYPE, [summary]),
+        (rh.RPMTAG_DESCRIPTION, rh.RPM_I18NSTRING_TYPE, [description]),
+        (rh.RPMTAG_BUILDTIME, rh.RPM_INT32_TYPE, [1420070400]),
+        (rh.RPMTAG_SIZE, rh.RPM_INT32_TYPE, [size]),
+        (rh.RPMTAG_LICENSE, rh.RPM_STRING_TYPE, b"ASL 2.0"),
+        (rh.RPMTAG_GROUP, rh.RPM_I18NSTRING_TYPE,
+            [b"System Environment/Libraries"]),
+    ]
+
+
+def make_repository(top):
+    """
+    Populate the zypper repository directory *top* with a binary package
+    with every kind of dependency, a noarch package, an i586 package
+    stored in the x86_64 directory and a source package
+    """
+    for arch in ["noarch", "src", "x86_64"]:
+        os.makedirs(os.path.join(top, "RPMS", arch))
+    write_rpm(
+        os.path.join(top, "RPMS", "x86_64",
+                     "globus-common-16.0-1.x86_64.rpm"),
+        b"globus-common", b"16.0", b"1", b"x86_64",
+        common_tags(
+            b"Globus Toolkit - Common Library",
+            b"The Globus Toolkit common library.\n\nIt is used by everything.",
+            3000000000) + [
+            (rh.RPMTAG_PROVIDENAME, rh.RPM_STRING_ARRAY_TYPE,
+                [b"globus-common", b"globus-common(x86-64)",
+                 b"libglobus_common.so.0()(64bit)"]),
+            (rh.RPMTAG_PROVIDEFLAGS, rh.RPM_INT32_TYPE,
+                [rh.RPMSENSE_EQUAL, rh.RPMSENSE_EQUAL, 0]),
+            (rh.RPMTAG_PROVIDEVERSION, rh.RPM_STRING_ARRAY_TYPE,
+                [b"16.0-1", b"16.0-1", b""]),
+            (rh.RPMTAG_REQUIRENAME, rh.RPM_STRING_ARRAY_TYPE,
+                [b"/sbin/ldconfig", b"/sbin/ldconfig",
+                 b"globus-common-progs", b"libc.so.6()(64bit)",
+                 b"rpmlib(CompressedFileNames)",
+                 b"rpmlib(PayloadFilesHavePrefix)"]),
+            (rh.RPMTAG_REQUIREFLAGS, rh.RPM_INT32_TYPE,
+                [rh.RPMSENSE_PREREQ | rh.RPMSENSE_SCRIPT_POST,
+                 rh.RPMSENSE_PREREQ | 0x800,
+                 rh.RPMSENSE_GREATER | rh.RPMSENSE_EQUAL, 0,
+                 rh.RPMSENSE_RPMLIB | rh.RPMSENSE_LESS |
+                 rh.RPMSENSE_EQUAL,
+                 rh.RPMSENSE_RPMLIB | rh.RPMSENSE_LESS |
+                 rh.RPMSENSE_EQUAL]),
+            (rh.RPMTAG_REQUIREVERSION, rh.RPM_STRING_ARRAY_TYPE,
+                [b"", b"", b"16.0", b"", b"3.0.4-1", b"4.0-1"]),
+            (rh.RPMTAG_CONFLICTNAME, rh.RPM_STRING_ARRAY_TYPE,
+                [b"globus-libtool"]),
+            (rh.RPMTAG_CONFLICTFLAGS, rh.RPM_INT32_TYPE,
+                [rh.RPMSENSE_LESS]),
+            (rh.RPMTAG_CONFLICTVERSION, rh.RPM_STRING_ARRAY_TYPE,
+                [b"2.0"]),
+            (rh.RPMTAG_OBSOLETENAME, rh.RPM_STRING_ARRAY_TYPE,
+                [b"globus-libtool"]),
+            (rh.RPMTAG_OBSOLETEFLAGS, rh.RPM_INT32_TYPE,
+                [rh.RPMSENSE_LESS]),
+            (rh.RPMTAG_OBSOLETEVERSION, rh.RPM_STRING_ARRAY_TYPE,
+                [b"2.0"]),
+        ])
+    write_rpm(
+        os.path.join(top, "RPMS", "noarch",
+                     "globus-common-doc-16.0-1.noarch.rpm"),
+        b"globus-common-doc", b"16.0", b"1", b"noarch",
+        common_tags(
+            b"Globus Toolkit - Common Library Documentation",
+            b"Documentation for the common library.\n", 12345) + [
+            (rh.RPMTAG_EPOCH, rh.RPM_INT32_TYPE, [1]),
+            (rh.RPMTAG_PROVIDENAME, rh.RPM_STRING_ARRAY_TYPE,
+                [b"globus-common-doc"]),
+            (rh.RPMTAG_PROVIDEFLAGS, rh.RPM_INT32_TYPE,
+                [rh.RPMSENSE_EQUAL]),
+            (rh.RPMTAG_PROVIDEVERSION, rh.RPM_STRING_ARRAY_TYPE,
+                [b"1:16.0-1"]),
+        ])
+    write_rpm(
+        os.path.join(top, "RPMS", "x86_64",
+                     "globus-common-32bit-16.0-1.i586.rpm"),
+        b"globus-common-32bit", b"16.0", b"1", b"i586",
+        common_tags(b"32-bit common library", b"", 0))
+    write_rpm(
+        os.path.join(top, "RPMS", "src", "globus-common-16.0-1.src.rpm"),
+        b"globus-common", b"16.0", b"1", b"x86_64",
+        common_tags(b"Globus Toolkit - Common Library", b"Source.", 0) + [
+            (rh.RPMTAG_REQUIRENAME, rh.RPM_STRING_ARRAY_TYPE,
+                [b"doxygen"]),
+            (rh.RPMTAG_REQUIREFLAGS, rh.RPM_INT32_TYPE, [0]),
+            (rh.RPMTAG_REQUIREVERSION, rh.RPM_STRING_ARRAY_TYPE, [b""]),
+        ],
+        source=False)
+
+
+class ZypperDescrTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = repo.cache_dir
+        repo.cache_dir = None
+        self.top = tempfile.mkdtemp()
+        make_repository(self.top)
+        self.descr_dir = os.path.join(self.top, "setup", "descr")
+        os.makedirs(self.descr_dir)
+
+    def tearDown(self):
+        repo.cache_dir = self.cache_dir
+        shutil.rmtree(self.top)
+
+    def test_descr_files(self):
+        repository = repo.zypper.Repository.__new__(repo.zypper.Repository)
+        repository.repo_path = self.top
+        hashes = getattr(repository, "_Repository__write_descr")(
+            self.descr_dir)
+        self.assertEqual(sorted(hashes), ["packages", "packages.en"])
+        for name in hashes:
+            f = open(os.path.join(data_dir, name), "rb")
+            try:
+                expected = f.read()
+            finally:
+                f.close()
+            f = open(os.path.join(self.descr_dir, name), "rb")
+            try:
+                actual = f.read()
+            finally:
+                f.close()
+            self.assertEqual(actual, expected, name)
+            self.assertEqual(hashes[name], hashlib.sha1(actual).hexdigest())
+
+    def test_stale_disk_usage(self):
+        du_path = os.path.join(self.descr_dir, "packages.DU")
+        f = open(du_path, "wb")
+        try:
+            f.write(b"=Ver: 2.0\n")
+        finally:
+            f.close()
+        repository = repo.zypper.Repository.__new__(repo.zypper.Repository)
+        repository.repo_path = self.top
+        getattr(repository, "_Repository__write_descr")(self.descr_dir)
+        self.assertEqual(
+            sorted(os.listdir(self.descr_dir)), ["packages", "packages.en"])
+
+    def test_unsigned_integers(self):
+        path = os.path.join(
+            self.top, "RPMS", "x86_64", "globus-common-16.0-1.x86_64.rpm")
+        values = rh.read_header(path, set([
+            rh.RPMTAG_SIZE, rh.RPMTAG_REQUIREFLAGS]))
+        self.assertEqual(values[rh.RPMTAG_SIZE], [3000000000])
+        self.assertTrue(all(
+            flags >= 0 for flags in values[rh.RPMTAG_REQUIREFLAGS]))
+
+
+if __name__ == '__main__':
+    unittest.main()